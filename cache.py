@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Tiny response cache for the stats commands, so people spamming !stats and !top after
+# a big fight don't hit the database every single time.
+import collections
+
+
+class ResponseCache:
+    """
+    A dict that keeps count of its hits and misses. Keys are tuples whose first item is the
+    kind of response, e.g. ('stats', 'polsaker') or ('top',). Only the `maxsize` most recently
+    used entries are kept.
+    """
+    def __init__(self, maxsize=1024):
+        self.entries = collections.OrderedDict()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """
+        Return the cached value for key, calling build() to fill it in on a miss. Empty results
+        ("no stats for that nick") aren't kept, anybody could make up as many of those as they like.
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = build()
+            if value:
+                self.entries[key] = value
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+            return value
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def invalidate_kind(self, kind):
+        """Drop every entry of one kind, e.g. all the ('stats', ...) responses."""
+        for key in [k for k in self.entries if k[0] == kind]:
+            del self.entries[key]
+
+    def summary(self):
+        total = self.hits + self.misses
+        return "{0} entries, {1} hits, {2} misses ({3:.0%} hit rate)".format(len(self.entries), self.hits, self.misses,
+                                                                            self.hits / total if total else 0)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Turns the old GameStats rows into per-day totals, for the one-time backfill of the daily
+# rollups (GameDaily and PlayerDaily in dongerdong.py). GameStats doesn't know about deathmatches,
+# quits or idleouts, so those days only get the rest, and (like the head-to-head backfill) players
+# are whatever nicks they were challenged with. Unfinished games (no winner) are left out, like
+# the live rollups leave them out.
+
+
+def rows(games):
+    """Returns (GameDaily rows, PlayerDaily rows) as dicts, from GameStats rows."""
+    days, players = {}, {}
+    for game in games:
+        if not game.winner:
+            continue
+        day = game.time.date()
+        total = days.setdefault(day, {'day': day, 'games': 0, 'turns': 0})
+        total['games'] += 1
+        total['turns'] += game.turns  # Once per game, like rollupGame does
+        for n in (1, 2):
+            counts = {'matches': 1,
+                      'hits': getattr(game, 'player{0}_hits'.format(n)), 'heals': getattr(game, 'player{0}_heals'.format(n)),
+                      'praises': 1 if getattr(game, 'player{0}_praise'.format(n)) else 0,
+                      'totdmg': getattr(game, 'player{0}_totdmg'.format(n)), 'totheal': getattr(game, 'player{0}_totheal'.format(n)),
+                      'crits': getattr(game, 'player{0}_crits'.format(n)),
+                      'wins': 1 if game.winner == n else 0, 'losses': 1 if game.winner == 3 - n else 0}
+            row = players.setdefault((day, getattr(game, 'player{0}'.format(n)).lower()),
+                                     {'day': day, 'name': getattr(game, 'player{0}'.format(n))})
+            row['turns'] = row.get('turns', 0) + game.turns  # Everybody in it played all of its turns
+            for stat, value in counts.items():
+                row[stat] = row.get(stat, 0) + value
+                total[stat] = total.get(stat, 0) + value
+    return list(days.values()), list(players.values())
@@ -4,32 +4,92 @@ import asyncio
 import pydle
 import json
 import logging
+import logging.handlers
+import queue
+import atexit
 import threading
 import random
 import time
 from pyfiglet import Figlet
 import copy
+import collections
 import peewee
+from playhouse.migrate import SqliteMigrator, migrate
 import importlib
 import subprocess
 import datetime
-
-loggingFormat = '%(asctime)s %(levelname)s:%(name)s: %(message)s'
-logging.basicConfig(level=logging.DEBUG, format=loggingFormat)
+import os
+import formatting
+import cache
+import profiler
+import statsapi
+import handoff
+import odds
+import extruntime
+import watchdog
+import spectate
+import lean
+import daily
 
 config = json.load(open("config.json"))
 
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats every record before queueing it, which is exactly the work we
+    # want off the event loop. Records never leave the process, so they don't need to be picklable.
+    def prepare(self, record):
+        return record
+
+
+class WireLine:
+    # A raw IRC line that only gets decoded if somebody actually logs it
+    __slots__ = ('data', 'encoding')
+
+    def __init__(self, data, encoding):
+        self.data = data
+        self.encoding = encoding
+
+    def __str__(self):
+        data = self.data if isinstance(self.data, str) else self.data.decode(self.encoding, 'replace')
+        return data.replace('\r\n', '')
+
+
+# Logging goes through a queue and the actual formatting and writing happens on the listener
+# thread, so a busy fight never waits on the terminal or the disk.
+def setupLogging():
+    loggingFormat = '%(asctime)s %(levelname)s:%(name)s: %(message)s'
+    logHandlers = [logging.StreamHandler()]
+    if config.get('log-file'):
+        logHandlers.append(logging.handlers.RotatingFileHandler(config['log-file'], maxBytes=config.get('log-max-bytes', 10485760),
+                                                                backupCount=config.get('log-backups', 5), encoding='utf-8'))
+    for handler in logHandlers:
+        handler.setFormatter(logging.Formatter(loggingFormat))
+
+    logQueue = queue.SimpleQueue()
+    logging.basicConfig(level=config.get('log-level', 'DEBUG').upper(), handlers=[LazyQueueHandler(logQueue)])
+    for name, level in config.get('log-levels', {}).items():  # e.g. {"pydle": "INFO"} to keep the wire traffic out
+        logging.getLogger(name).setLevel(level.upper())
+
+    logListener = logging.handlers.QueueListener(logQueue, *logHandlers, respect_handler_level=True)
+    logListener.start()
+    atexit.register(logListener.stop)
+
+
 BaseClient = pydle.featurize(pydle.features.RFC1459Support, pydle.features.WHOXSupport,
                              pydle.features.AccountSupport, pydle.features.TLSSupport,
                              pydle.features.IRCv3_1Support)
 
+ACCOUNT_WHOX = '061'  # WHOX query type for our own account lookups (pydle uses 542 for its own)
+
 
-class Donger(BaseClient):
+class Donger(lean.LeanChannels, BaseClient):
     def __init__(self, nick, *args, **kwargs):
         super().__init__(nick, *args, **kwargs)
 
         # This is to remember the millions of misc variable names
-        self.pendingFights = {}  # Pending (not !accepted) fights. ({'player': {'ts': 123, 'deathmatch': False, 'versusone': False, 'players': [...], 'pendingaccept': [...]}, ...}
+        self.pendingFights = {}  # Pending (not !accepted) fights, oldest first. ({'player': {'ts': 123, 'deathmatch': False, 'versusone': False, 'players': [...], 'pendingaccept': {...}, 'openspots': 0}, ...}
+        self.challenges = {}  # Reverse index of pendingFights: challengee -> challengers, oldest first. ({'ravioli': {'polsaker': True}, ...})
+        self.openFights = collections.OrderedDict()  # Pending fights with open (*) spots, oldest first. ({'polsaker': True, ...})
 
         # Game vars (Reset these in self.win)
         self.deathmatch = False
@@ -39,10 +99,17 @@ class Donger(BaseClient):
         self.gdrmodifier = 1  # Modifier for damage reduction adjustment, increase for higher defense, decrease for lower defense
         self.turnlist = []  # Same as self.players, but only the player nicks. Shuffled when the game starts (used to decide turn orders)
         self.accountlist = []  # list of accounts of every player that joined the current fight
+        self.gamecounts = {}  # What countStat counted this game, for the daily rollups. {'Polsaker': {'hits': 3, ...}, ...}
         self.currentTurn = -1  # current turn = turnlist[currentTurn]
+        self.royale = False  # True if the current game is a battle royale
+        self.royaleRound = 0  # Current battle royale round
+        self.royaleActions = {}  # Actions picked for the current royale round. {'polsaker': ('hit', 'ravioli'), 'ravioli': ('heal', None), ...}
+
+        self.royaleSignup = None  # Open battle royale signup. {'ts': 123, 'players': [...], 'accounts': [...]}
 
         self.channel = config['channel']  # Main fight channel
         self.currentchannels = []  # List of current channels the bot is in
+        self.lean = config.get('lean-auxchans', True)  # Don't track who's in the other channels, see lean.py
         self.lastheardfrom = {}  # lastheardfrom['Polsaker'] = time.time()
         self.sourcehistory = []  # sourcehistory.append(source)
         self.lastbotfight = time.time() - 15  # Last time the bot was in a fight.
@@ -51,12 +118,46 @@ class Donger(BaseClient):
 
         self.currgamerecord = None  # GameStats object for current game
 
-        self.eventloop.create_task(self._timeout())
+        self.accountcache = {}  # Nick -> account cache. accountcache['polsaker'] = ('Polsaker', time.time()) (None if not identified)
+        self.pendingwho = {}  # Account WHOX lookups waiting for their RPL_ENDOFWHO. {'#channel': Future}
+
+        self.statscache = cache.ResponseCache(config.get('stats-cache-size', 1024))  # !stats/!top/!shame responses. Cleared by countStat and the ELO update in win
+        self.profiler = profiler.Profiler(config.get('profile-dir', 'profiles'))  # For !profile
+
+        self.odds = odds.Odds(config.get('odds-dir', '.'))  # Win chances for 1v1s, for !odds and the turn announcements
+        if not self.odds.load():
+            logging.info("Solving the odds tables, this takes a few minutes")
+            self.eventloop.run_in_executor(None, self.odds.build)
+
+        self.recentgames = collections.deque(map(self.gameDict, GameStats.select().where(GameStats.winner != 0)
+                                                 .order_by(GameStats.id.desc()).limit(config.get('api-recent-games', 20))),
+                                             maxlen=config.get('api-recent-games', 20))  # Newest first, for the stats API
+        self.spectators = spectate.Relay()  # Live fight events for the spectator-chans and /live
+        self.spectatorPump = None  # Task relaying the fight to the spectator-chans
+        self.lastOutput = 0  # time.monotonic() of the last thing we said that wasn't for the spectators
+        self.api = statsapi.StatsAPI(self.statscache)
+        if config.get('api-port'):
+            self.api.route('/leaderboard', self.apiLeaderboard, params={'limit': statsapi.number(10, 1, 100), 'order': statsapi.oneof('top', 'shame')})
+            self.api.route('/player/', self.apiPlayer, prefix=True, cacheable=False)  # Comes out of the ('stats', ...) cache anyway
+            self.api.route('/games', self.apiGames)
+            self.api.route('/fight', self.apiFight, cacheable=False)
+            self.api.route('/daily', self.apiDaily, params={'days': statsapi.number(30, 1, 3650)})
+            self.api.route('/daily/', self.apiDaily, prefix=True, params={'days': statsapi.number(30, 1, 3650)})
+            self.api.stream('/live', self.liveEvents)
+
+        self.timeoutTask = self.eventloop.create_task(self._timeout(), name="timers")
+
+        # Tells us when something hogs the event loop, and what it was (see !lag and the stall report)
+        self.watchdog = watchdog.Watchdog(self.eventloop, config.get('stall-threshold', 0.5), config.get('stall-report', 'stalls.log'))
+        self.watchdog.start()
+        self.eventloop.create_task(self.watchdog.heartbeat(), name="heartbeat")
 
         self.import_extcmds()
 
     async def on_connect(self):
         await super().on_connect()
+        self.startAPI()
+        self.startSpectators()
         await self.join(self.channel)
         self.currentchannels.append(self.channel)
         for chan in config.get('auxchans', []):
@@ -67,6 +168,7 @@ class Donger(BaseClient):
         if message.startswith("!"):
             command = message[1:].split(" ")[0].lower()
             args = message.rstrip().split(" ")[1:]
+            asyncio.current_task().set_name("!{0} from {1} in {2}".format(command, source, target))  # For the stall reports
 
             if target == self.channel:  # Dongerdong command
                 if (command == "fight" or command == "deathmatch" or command == "duel") and not self.gameRunning:
@@ -75,7 +177,15 @@ class Donger(BaseClient):
                         await self.message(target, "Can you read? It is !{0} <nick>{1}".format(command, " [othernick] [...] " if command == "fight" else ""))
                         return
 
-                    if not self.users[source]['account']:
+                    if self.royaleSignup:  # royaleStart needs the channel to itself
+                        await self.message(target, "There's a battle royale about to start, sign up with \002!royale\002 instead!")
+                        return
+
+                    # Look everybody up in one go (fight() gets the answers). Only the ones that are
+                    # actually here, made up nicks would just cost a WHO of the whole channel.
+                    here = set(map(str.lower, self.channels[self.channel]['users']))
+                    accounts = await self.resolveAccounts([source] + [x for x in args if x != "*" and x.lower() in here])
+                    if not accounts[source]:
                         await self.message(target, "You're not identified with NickServ!")
                         return
 
@@ -91,52 +201,71 @@ class Donger(BaseClient):
                         await self.message(target, "Challenges are 1v1 only.")
                         return
 
-                    await self.fight([source] + args, True if command == "deathmatch" else False, True if (command == "deathmatch" or command == "duel") else False)
+                    await self.fight([source] + args, True if command == "deathmatch" else False, True if (command == "deathmatch" or command == "duel") else False, accounts)
                 elif command == "accept" and not self.gameRunning:
-                    if not args:
-                        await self.message(target, "Can you read? It is !accept <nick>")
+                    if self.royaleSignup:
+                        await self.message(target, "There's a battle royale about to start, sign up with \002!royale\002 instead!")
                         return
 
-                    if not self.users[source]['account']:
+                    if not (await self.resolveAccounts([source]))[source]:
                         await self.message(target, "You're not identified with NickServ!")
                         return
 
-                    challenger = args[0].lower()
-                    opportunist = False
+                    if args:
+                        challenger = args[0].lower()
+                    else:  # Whoever challenged us, or else the oldest open challenge
+                        challengers = list(self.challenges.get(source.lower(), ()))
+                        if len(challengers) > 1:
+                            await self.message(target, "You've been challenged by {0}. Pick one with !accept <nick>".format(self.nicklist([self.pendingFights[c]['players'][0] for c in challengers])))
+                            return
+                        challenger = challengers[0] if challengers else next((c for c in self.openFights if source.lower() not in map(str.lower, self.pendingFights[c]['players'])), None)
+                        if not challenger:
+                            await self.message(target, "Nobody challenged you. Start a fight with \002!fight <nick>\002!")
+                            return
 
                     # Check if the user was challenged
-                    try:
-                        if source.lower() not in self.pendingFights[challenger]['pendingaccept']:
-                            if "*" in self.pendingFights[challenger]['pendingaccept']:
-                                if source.lower() == challenger:
-                                    await self.message(target, "You're trying to fight yourself?")
-                                    return
-
-                                opportunist = True
-                            else:
-                                await self.message(target, "Err... Maybe you meant to say \002!fight {0}\002? They never challenged you.".format(args[0]))
-                                return
-                    except KeyError:  # self.pendingFights[x] doesn't exist
-                        await self.message(target, "Err... Maybe you meant to say \002!fight {0}\002? They never challenged you.".format(args[0]))
+                    fight = self.pendingFights.get(challenger)
+                    if not fight or (source.lower() not in fight['pendingaccept'] and not fight['openspots']):
+                        await self.message(target, "Err... Maybe you meant to say \002!fight {0}\002? They never challenged you.".format(args[0] if args else challenger))
+                        return
+                    if source.lower() == challenger:
+                        await self.message(target, "You're trying to fight yourself?")
+                        return
+                    if source.lower() in map(str.lower, fight['players']):
+                        await self.message(target, "You're already in that fight.")
                         return
 
                     # Check if the challenger is here
-                    if args[0].lower() not in map(str.lower, self.channels[self.channel]['users']):
+                    if challenger not in map(str.lower, self.channels[self.channel]['users']):
                         await self.message(target, "They're not here anymore - maybe they were intimidated by your donger.")
-                        del self.pendingFights[challenger]  # remove fight.
+                        self.dropPendingFight(challenger)  # remove fight.
                         return
 
                     # OK! This player accepted the fight.
-                    self.pendingFights[challenger]['players'].append(source)
-                    if not opportunist:
-                        self.pendingFights[challenger]['pendingaccept'].remove(source.lower())
-                    else:
-                        self.pendingFights[challenger]['pendingaccept'].remove('*')
+                    self.takeSpot(challenger, source)
 
                     # Check if everybody accepted
-                    if not self.pendingFights[challenger]['pendingaccept']:
+                    if not fight['pendingaccept'] and not fight['openspots']:
                         # Start the game!
-                        await self.start(self.pendingFights[challenger])
+                        await self.start(fight)
+                elif command == "royale" and not self.gameRunning:
+                    account = (await self.resolveAccounts([source]))[source]
+                    if not account:
+                        await self.notice(source, "You're not identified with NickServ!")
+                        return
+
+                    if not self.royaleSignup:
+                        self.royaleSignup = {'ts': time.time(), 'players': [source], 'accounts': [account]}
+                        await self.message(target, "\002{0}\002 started a BATTLE ROYALE! Use !royale in the next {1} seconds to sign up.".format(source, config.get('royale-signup', 60)))
+                        return
+
+                    if account in self.royaleSignup['accounts']:
+                        return  # No clones, and no acknowledgements either. Hundreds of people will be typing this.
+
+                    self.royaleSignup['players'].append(source)
+                    self.royaleSignup['accounts'].append(account)
+                elif command in ("hit", "heal") and self.royale:
+                    await self.royaleAction(source, command, args)
                 elif command == "hit" and self.gameRunning:
                     if source != self.turnlist[self.currentTurn]:
                         await self.message(self.channel, "It's not your fucking turn!")
@@ -170,7 +299,7 @@ class Donger(BaseClient):
                         await self.message(target, await self.ascii(' '.join(args)))
                     else:
                         await self.message(target, "Text must be 15 characters or less (that was {0} characters). Syntax: !ascii Fuck You".format(len(' '.join(args))))
-                elif command == "praise" and self.gameRunning:
+                elif command == "praise" and self.gameRunning and not self.royale:
                     if source != self.turnlist[self.currentTurn]:
                         await self.message(self.channel, "It's not your fucking turn!")
                         return
@@ -216,34 +345,45 @@ class Donger(BaseClient):
                     self.countStat(source, "praises")
 
                 elif command == "cancel" and not self.gameRunning:
-                    try:
-                        del self.pendingFights[source.lower()]
-                        await self.message(target, "Fight cancelled.")
-                    except KeyError:
+                    if not self.dropPendingFight(source.lower()):
                         await self.message(target, "You can only !cancel if you started a fight.")
                         return
+                    await self.message(target, "Fight cancelled.")
                 elif command == "reject" and not self.gameRunning:
-                    if not args:
-                        await self.message(target, "Can you read? It's !reject <nick>")
-                        return
-
-                    try:  # I could just use a try.. except in the .remove(), but I am too lazy to remove this chunk of code
-                        if source.lower() not in self.pendingFights[args[0].lower()]['pendingaccept']:
+                    if args:
+                        if args[0].lower() not in self.challenges.get(source.lower(), ()):
                             await self.message(target, "{0} didn't challenge you.".format(args[0]))
                             return
-                    except KeyError:  # if self.pendingFights[args[0].lower()] doesn't exist.
-                        await self.message(target, "{0} didn't challenge you.".format(args[0]))
-                        return
+                        challengers = [args[0].lower()]
+                    else:  # Turn all of them down
+                        challengers = list(self.challenges.get(source.lower(), ()))
+                        if not challengers:
+                            await self.message(target, "Nobody challenged you.")
+                            return
 
-                    self.pendingFights[args[0].lower()]['pendingaccept'].remove(source.lower())
                     await self.message(target, "\002{0}\002 fled the fight".format(source))
-
-                    if not self.pendingFights[args[0].lower()]['pendingaccept']:
-                        if len(self.pendingFights[args[0].lower()]['players']) == 1:  # only the challenger
-                            await self.message(target, "Fight cancelled.")
-                            del self.pendingFights[args[0].lower()]
-                        else:
-                            await self.start(self.pendingFights[args[0].lower()])
+                    for challenger in challengers:
+                        fight = self.pendingFights[challenger]
+                        self.unindexChallenge(challenger, source)
+                        fight['pendingaccept'].discard(source.lower())
+
+                        if not fight['pendingaccept'] and not fight['openspots']:
+                            if len(fight['players']) == 1:  # only the challenger
+                                await self.message(target, "{0}'s fight cancelled.".format(fight['players'][0]) if len(challengers) > 1 else "Fight cancelled.")
+                                self.dropPendingFight(challenger)
+                            else:
+                                await self.start(fight)
+                                break
+                elif command == "pending" and not self.gameRunning:
+                    challengers = [self.pendingFights[c]['players'][0] for c in self.challenges.get(source.lower(), ())]
+                    openfights = [self.pendingFights[c]['players'][0] for c in self.openFights if c != source.lower()]
+                    if not challengers and not openfights:
+                        await self.message(target, "Nobody challenged you.")
+                        return
+                    if challengers:
+                        await self.message(target, "You've been challenged by {0}. Use !accept <nick> or !reject <nick>.".format(self.nicklist(challengers)))
+                    if openfights:
+                        await self.message(target, "Open challenges from {0}. Use !accept <nick> to join one.".format(self.nicklist(openfights)))
                 elif command == "quit" and self.gameRunning:
                     await self.cowardQuit(source)
                 elif command == "stats" and not self.gameRunning:
@@ -251,12 +391,9 @@ class Donger(BaseClient):
                         nick = args[0]
                     else:
                         nick = source
-                    try:
-                        nick = self.users[nick]['account']
-                    except KeyError:
-                        pass
+                    nick = self.getAccount(nick) or nick
 
-                    stats = self.getStats(nick)
+                    stats = self.statscache.get(('stats', nick.lower()), lambda: self.getStats(nick))
 
                     if not stats:
                         return await self.message(target, "No stats for \002{0}\002.".format(nick))
@@ -265,8 +402,8 @@ class Donger(BaseClient):
 
                     balance = ("+" if balance > 0 else "") + str(balance)
 
-                    top = self.top_dongers().dicts()
-                    ranking = next((index for (index, d) in enumerate(top) if d['name'].lower() == stats.name.lower()), -1) + 1
+                    ranking = self.statscache.get(('ranking',), lambda: {d['name'].lower(): index + 1 for (index, d) in enumerate(self.top_dongers().dicts())})
+                    ranking = ranking.get(stats.name.lower(), 0)
 
                     if ranking == 0:
                         ranking = "\002Not ranked\002."
@@ -278,51 +415,94 @@ class Donger(BaseClient):
                         ranking = "Ranked \002\003063rd\003\002"
                     else:
                         ranking = "Ranked \002{}th\002".format(ranking)
-                    #try:
-                    #    d0 = stats.lastplayed.date()
-                    #    today = datetime.datetime.now().date()
-                    #    delta = today - d0
-                    #    aelo = stats.elo - (int(delta.days)*2) #aelo (adjusted ELO) is equal to normal ELO minus (days since last played times two)
-                    #except:
-                    #    await self.message(target, "You activated the special secret 1331589151jvlhjv feature!")
+
+                    points = "\002{0}\002 points".format(stats.elo)
+                    if config.get('decayed-leaderboard'):
+                        points += ", \002{0}\002 after decay".format(stats.decayed())
 
                     await self.message(target, "\002{0}\002's stats: \002{1}\002 wins, \002{2}\002 losses, \002{4}\002 coward quits, \002{5}\002 idle-outs (\002{3}\002), "
                                          "\002{6}\002 !praises, \002{7}\002 matches, \002{8}\002 deathmatches (\002{9}\002 total). "
-                                         "{11} (\002{10}\002 points)"
+                                         "{11} ({10})"
                                          .format(stats.name, stats.wins, stats.losses, balance, stats.quits, stats.idleouts, stats.praises,
-                                                 stats.matches, stats.deathmatches, (stats.matches + stats.deathmatches), stats.elo, ranking))
+                                                 stats.matches, stats.deathmatches, (stats.matches + stats.deathmatches), points, ranking))
+                elif command == "h2h" and not self.gameRunning:
+                    if not args or len(args) > 2:
+                        return await self.message(target, "Can you read? It is !h2h <nick> [othernick]")
+                    if len(args) == 1:
+                        args.insert(0, source)
+                    names = [self.getAccount(nick) or nick for nick in args]
+                    pair = HeadToHead.pair(*names)
+                    record = self.statscache.get(('h2h',) + pair, lambda: HeadToHead.lookup(*pair))
+
+                    if not record:
+                        return await self.message(target, "\002{0}\002 and \002{1}\002 never fought each other.".format(*names))
+                    if pair[0] != names[0].lower():  # Stored in alphabetical order, show it in the order they asked
+                        wins, damage = (record.player2_wins, record.player1_wins), (record.player2_totdmg, record.player1_totdmg)
+                    else:
+                        wins, damage = (record.player1_wins, record.player2_wins), (record.player1_totdmg, record.player2_totdmg)
+                    await self.message(target, "\002{0}\002 vs \002{1}\002: \002{2}\002 - \002{3}\002 in \002{4}\002 games, "
+                                               "\002{5}\002 vs \002{6}\002 damage dealt. Last fought on {7}."
+                                               .format(names[0], names[1], wins[0], wins[1], record.games, damage[0], damage[1],
+                                                       record.lastplayed.strftime("%Y-%m-%d")))
+                elif command == "odds":
+                    if not self.odds.ready:
+                        return await self.message(target, "Still crunching the numbers, try again in a few minutes.")
+                    if self.gameRunning:
+                        mover = self.turnlist[self.currentTurn]
+                        chance = self.winChance(mover)
+                        if chance is None:
+                            return await self.message(target, "I only know the odds for two dongers fighting it out.")
+                        other = [p['nick'] for p in self.players.values() if p['hp'] > 0 and p['nick'] != mover][0]
+                        return await self.message(target, "\002{0}\002: {1:.1%}, \002{2}\002: {3:.1%} ({0}'s turn)".format(mover, chance, other, 1 - chance))
+                    if len(args) < 2 or not all(x.isdigit() for x in args[:4]):
+                        return await self.message(target, "Can you read? It is !odds <hp> <their hp> [heals] [their heals]")
+                    hp, opphp = int(args[0]), int(args[1])
+                    heals, oppheals = (int(args[2]) if len(args) > 2 else 5), (int(args[3]) if len(args) > 3 else 5)
+                    if not (0 < hp <= 100 and 0 < opphp <= 100 and heals <= 5 and oppheals <= 5):
+                        return await self.message(target, "HP goes from 1 to 100 and you can't have more than 5 heals.")
+                    await self.message(target, "With {0}HP and {1} heals against {2}HP and {3} heals, on your turn: {4:.1%} to win a duel ({5:.1%} in a !fight)".format(
+                        hp, heals, opphp, oppheals, self.odds.chance(hp, heals, opphp, oppheals), self.odds.chance(hp, heals, opphp, oppheals, True)))
+                elif command == "activity" and not self.gameRunning:
+                    days = int(args[0]) if args and args[0].isdigit() and 0 < int(args[0]) <= 365 else 7
+                    total, active = self.statscache.get(('activity', days, datetime.date.today()), lambda: self.activity(days))
+                    if not total['games']:
+                        return await self.message(target, "Nobody fought in the last {0} days. Cowards.".format(days))
+                    await self.message(target, "Last {0} days: \002{1}\002 games ({2:.1f} a day), \002{3}\002 of them deathmatches. {4} hits ({5:.1%} crits) and {6} heals.".format(
+                        days, total['games'], total['games'] / days, total['deathmatches'] // 2, total['hits'],
+                        total['crits'] / total['hits'] if total['hits'] else 0, total['heals']))
+                    if active:
+                        await self.message(target, "Most active: {0}".format(", ".join("\002{0}\002 ({1})".format(*p) for p in active)))
                 elif command in ("top", "shame") and not self.gameRunning:
-                    p = self.top_dongers((command == "shame")).limit(5)  # If command == shame, then we're passing "True" into the top_dongers function below (in the "bottom" argument), overriding the default False
+                    p = self.statscache.get((command,), lambda: list(self.top_dongers((command == "shame")).limit(5)))  # If command == shame, then we're passing "True" into the top_dongers function below (in the "bottom" argument), overriding the default False
                     if not p:
                         return await self.message(target, "No top dongers.")
                     c = 1
                     for player in p:
                         playernick = "{0}\u200b{1}".format(player.name[0], player.name[1:])
 
-                        await self.message(target, "{0} - \002{1}\002 (\002{2}\002)".format(c, playernick.upper(), player.elo))
+                        await self.message(target, "{0} - \002{1}\002 (\002{2}\002)".format(c, playernick.upper(), player.decayed() if config.get('decayed-leaderboard') else player.elo))
                         c += 1
 
                     if config.get('stats-url'):
                         await self.message(target, "Full stats at {}".format(config['stats-url']))
 
             elif target == config['nick']:  # private message
-                if command == "join" and self.gameRunning and not self.versusone:
-                    try:
-                        self.users[source]['account']
-                    except KeyError:  # ????
-                        return await self.notice(source, "You don't exist. Try leaving and joining the channel again.")
-                    if self.users[source]['account'] in self.accountlist:
+                if command == "join" and self.gameRunning and not self.versusone and not self.royale:
+                    account = (await self.resolveAccounts([source]))[source]
+                    if not account:
+                        return await self.notice(source, "You're not identified with NickServ!")
+                    if account in self.accountlist:
                         await self.notice(source, "You already played in this game.")
                         return
 
-                    self.accountlist.append(self.users[source]['account'])
+                    self.accountlist.append(account)
                     alivePlayers = [self.players[player]['hp'] for player in self.players if self.players[player]['hp'] > 0]
                     health = int(sum(alivePlayers) / len(alivePlayers))
                     self.turnlist.append(source)
                     self.players[source.lower()] = {'hp': health, 'heals': 4, 'zombie': False, 'nick': source, 'praised': False, 'gdr': 1}
                     await self.message(self.channel, "\002{0}\002 JOINS THE FIGHT (\002{1}\002HP)".format(source.upper(), health))
                     await self.set_mode(self.channel, "+v", source)
-                elif command == "join" and self.versusone:
+                elif command == "join" and (self.versusone or self.royale):
                     await self.notice(source, "You can't join this fight")
                     return
 
@@ -351,21 +531,66 @@ class Donger(BaseClient):
                 await self.message(source, "  !fight <nickname> [othernicknames]: Challenge another player, or multiple players.")
                 await self.message(source, "  !duel <nickname>: Same as fight, but only 1v1.")
                 await self.message(source, "  !deathmatch <nickname>: Same as duel, but the loser is bant for 20 minutes.")
+                await self.message(source, "  !royale: Starts (or signs you up for) a battle royale. Everybody acts at the same time, last one standing wins.")
                 await self.message(source, "  !ascii <text>: Turns any text 15 characters or less into ascii art")
                 await self.message(source, "  !cancel: Cancels a !fight")
-                await self.message(source, "  !reject <nick>: Rejects a !fight")
+                await self.message(source, "  !accept [nick]: Accepts a !fight (whoever challenged you if you leave the nick out)")
+                await self.message(source, "  !reject [nick]: Rejects a !fight (all of them if you leave the nick out)")
+                await self.message(source, "  !pending: Lists who challenged you")
                 await self.message(source, "  !stats [player]: Outputs player's game stats (or your own stats)")
                 await self.message(source, "  !top, !shame: Lists the best, or the worst, players")
+                await self.message(source, "  !h2h <player> [otherplayer]: Head-to-head record of two players (or you and somebody else)")
+                await self.message(source, "  !odds [hp theirhp [heals theirheals]]: Chances of winning the current 1v1 (or a made up one)")
+                await self.message(source, "  !activity [days]: How much fighting went on in the last few days (7 by default)")
                 await self.message(source, "Commands available everywhere:")
                 for ch in self.cmdhelp.keys():  # Extended commands help
                     await self.message(source, "  !{}: {}".format(ch, self.cmdhelp[ch]))
+            elif command == "profile" and await self.isAdmin(source):
+                if not args or args[0] not in ("start", "stop"):
+                    return await self.message(target, "Usage: !profile start [cprofile|sample], !profile stop [top N]")
+                if args[0] == "start":
+                    if self.profiler.kind:
+                        return await self.message(target, "Already running a {0} capture.".format(self.profiler.kind))
+                    kind = args[1] if len(args) > 1 and args[1] in ("cprofile", "sample") else "cprofile"
+                    self.profiler.start(kind, config.get('profile-interval', 0.005))
+                    await self.message(target, "Started a {0} capture. Use !profile stop when you've seen enough.".format(kind))
+                else:
+                    if not self.profiler.kind:
+                        return await self.message(target, "I'm not profiling anything.")
+                    path, hotspots = self.profiler.stop(int(args[1]) if len(args) > 1 and args[1].isdigit() else 10)
+                    await self.message(source, "Report written to {0}. Hotspots:".format(path))
+                    for line in hotspots:
+                        await self.message(source, "  " + line)
+            elif command == "memprofile" and await self.isAdmin(source):
+                if not args or not args[0].isdigit() or not 0 < int(args[0]) <= 3600:
+                    return await self.message(target, "Usage: !memprofile <seconds (up to 3600)> [top N]")
+                # A second one would have the first one's tracemalloc.stop() pulled out from under it
+                if self.profiler.memwatch:
+                    return await self.message(target, "Already watching memory, wait for that report.")
+                await self.message(target, "Watching memory for {0} seconds...".format(args[0]))
+                self.profiler.memwatch = True
+                try:
+                    path, growth = await profiler.memdiff(int(args[0]), int(args[1]) if len(args) > 1 and args[1].isdigit() else 10,
+                                                          config.get('profile-dir', 'profiles'))
+                finally:
+                    self.profiler.memwatch = False
+                await self.message(source, "Report written to {0}. Biggest growth:".format(path))
+                for line in growth:
+                    await self.message(source, "  " + line)
+            elif command == "extstats" and await self.isAdmin(source):
+                for line in self.extruntime.report(args):
+                    await self.message(source, line)
+            elif command == "lag" and await self.isAdmin(source):
+                await self.message(target, self.watchdog.summary())
+            elif command == "cachestats" and await self.isAdmin(source):
+                await self.message(target, "Stats cache: {0}".format(self.statscache.summary()))
             elif command == "version":
                 try:
                     ver = subprocess.check_output(["git", "describe", "--tags"]).decode().strip()
                     await self.message(target, "I am running {} ({})".format(ver, 'http://bit.ly/1pG2Hay'))
                 except:
                     await self.message(target, "I have no idea.")
-            elif command == "part" and self.users[source]['account'] in config['admins']:
+            elif command == "part" and await self.isAdmin(source):
                 if not args:
                     return await self.message(target, "You need to list the channel you want me to leave.")
                 if args[0] not in self.currentchannels:
@@ -378,7 +603,7 @@ class Donger(BaseClient):
                     self.currentchannels.remove(args[0])
                 except:
                     pass
-            elif command == "join" and self.users[source]['account'] in config['admins']:
+            elif command == "join" and await self.isAdmin(source):
                 if not args:
                     return await self.message(target, "You need to list the channel you want me to join.")
                 if args[0] in self.currentchannels:
@@ -391,13 +616,91 @@ class Donger(BaseClient):
                     pass
             elif command in self.extcmds:  # Extended commands support
                 try:
-                    if self.cmds[command].adminonly and self.users[source]['account'] not in config['admins']:
+                    if self.cmds[command].adminonly and not await self.isAdmin(source):
                         return
                 except AttributeError:
                     pass
-                await self.cmds[command].doit(self, target, source)
+                await self.extruntime.run(command, self, target, source, args)
+
+    def getAccount(self, nick):
+        # Account for nick, from the cache if it's fresh enough, otherwise whatever pydle knows
+        try:
+            account, ts = self.accountcache[nick.lower()]
+            if time.time() - ts < config.get('account-cache-ttl', 600):
+                return account
+        except KeyError:
+            pass
+
+        try:
+            return self.users[nick]['account']
+        except KeyError:
+            return None
+
+    async def isAdmin(self, nick):
+        # Looked up instead of read from pydle, it doesn't know the accounts of people in lean channels
+        return (await self.resolveAccounts([nick]))[nick] in config['admins']
+
+    def cacheAccount(self, nick, account):
+        self.accountcache[nick.lower()] = (account, time.time())
+        if nick in self.users:
+            self.users[nick]['account'] = account
+
+    async def resolveAccounts(self, nicks):
+        # Returns {nick: account}. Everybody missing from the cache is looked up with a single WHOX:
+        # the nick itself if it's just one, otherwise the whole fight channel (every ircd supports that one)
+        missing = [nick for nick in nicks if nick.lower() not in self.accountcache or
+                   time.time() - self.accountcache[nick.lower()][1] >= config.get('account-cache-ttl', 600)]
+
+        if missing and self._isupport.get('WHOX'):
+            mask = (missing[0] if len(missing) == 1 else self.channel).lower()
+            if mask not in self.pendingwho:
+                self.pendingwho[mask] = self.eventloop.create_future()
+                await self.rawmsg('WHO', mask, '%tna,{0}'.format(ACCOUNT_WHOX))
+            try:
+                await asyncio.wait_for(asyncio.shield(self.pendingwho[mask]), config.get('whox-timeout', 5))
+            except asyncio.TimeoutError:
+                logging.warning("WHOX lookup for {0} timed out".format(mask))
+                self.pendingwho.pop(mask, None)
+
+        return {nick: self.getAccount(nick) for nick in nicks}
+
+    async def on_raw_354(self, message):
+        await super().on_raw_354(message)
+        # Both our lookups and pydle's WHOX on join feed the cache
+        if message.params[1] == ACCOUNT_WHOX:
+            nick, account = message.params[2:4]
+        elif message.params[1] == pydle.features.whox.WHOX_IDENTIFIER:
+            nick, account = message.params[4:6]
+        else:
+            return
+        self.cacheAccount(nick, account if account != '0' else None)
+
+    async def on_raw_315(self, message):
+        await super().on_raw_315(message)
+        future = self.pendingwho.pop(message.params[1].lower(), None)
+        if future and not future.done():
+            future.set_result(True)
+
+    async def on_raw_account(self, message):
+        await super().on_raw_account(message)
+        nick, metadata = self._parse_user(message.source)
+        self.cacheAccount(nick, message.params[0] if message.params[0] != '*' else None)
+
+    async def on_raw_join(self, message):
+        await super().on_raw_join(message)
+        nick, metadata = self._parse_user(message.source)
+        if len(message.params) == 3 and nick in self.users:  # extended-join tells us the account for free (not kept for lean channels)
+            self.cacheAccount(nick, message.params[1] if message.params[1] != '*' else None)
+
+    async def on_nick_change(self, old, new):
+        # With account-notify the account sticks across nick changes, otherwise we have to ask again
+        cached = self.accountcache.pop(old.lower(), None)
+        if cached and self._capabilities.get('account-notify'):
+            self.accountcache[new.lower()] = cached
 
     async def on_quit(self, user, message=None):
+        self.accountcache.pop(user.lower(), None)
+
         if self.gameRunning:
             await self.cowardQuit(user)
 
@@ -407,10 +710,12 @@ class Donger(BaseClient):
 
     def top_dongers(self, bottom=False):
         players = PlayerStats.select().where((PlayerStats.matches + PlayerStats.deathmatches) >= 15)
+        # decaykey sorts exactly like the decayed ELO does, and it doesn't change while time passes
+        order = PlayerStats.decaykey if config.get('decayed-leaderboard') else PlayerStats.elo
         if bottom:
-            players = players.order_by(PlayerStats.elo.asc())
+            players = players.order_by(order.asc())
         else:
-            players = players.order_by(PlayerStats.elo.desc())
+            players = players.order_by(order.desc())
 
         return players
 
@@ -421,6 +726,18 @@ class Donger(BaseClient):
         if self.players[coward.lower()]['hp'] <= 0:  # check if it is alive
             return
 
+        if self.royale:
+            # No ASCII art for every single coward in a battle royale, they're
+            # listed (and kicked) with the rest of the dead at the end of the round.
+            self.players[coward.lower()]['hp'] = -1
+            self.players[coward.lower()]['coward'] = True
+            alive = [p for p in self.players if self.players[p]['hp'] > 0]
+            if len(alive) <= 1:  # Nobody left to fight
+                await self.royaleEnd(alive[0] if alive else None)
+            elif self.turnStart and self.royaleAllActed():  # They might have been the last one we were waiting for
+                await self.royaleResolve()
+            return
+
         await self.ascii("COWARD")
         await self.message(self.channel, "The coward is dead!")
 
@@ -446,8 +763,8 @@ class Donger(BaseClient):
                 await self.win(survivor, False)
 
     async def akick(self, user, time=20, message="FUCKING REKT"):
-        # Resolve user account
-        user = self.users[user]['account']
+        # Resolve user account (or ban the nick if we really have no idea)
+        user = self.getAccount(user) or "{0}!*@*".format(user)
         await self.message("ChanServ", "AKICK {0} ADD {1} !T {2} {3}".format(self.channel, user, time, message))
 
     async def heal(self, target, critical=False):
@@ -487,8 +804,9 @@ class Donger(BaseClient):
                 if critical:
                     self.currgamerecord.player2_praiseroll = +healing
 
-        await self.message(self.channel, "\002{0}\002 heals for \002{1}HP\002, bringing them to \002{2}HP\002".format(
-            target, healing, self.players[target.lower()]['hp']))
+        line = "\002{0}\002 heals for \002{1}HP\002, bringing them to \002{2}HP\002".format(target, healing, self.players[target.lower()]['hp'])
+        await self.message(self.channel, line)
+        self.spectate('heal', line)
         await self.getTurn()
 
     async def hit(self, source, target, critical=False):
@@ -537,8 +855,10 @@ class Donger(BaseClient):
                 if critical:
                     self.currgamerecord.player2_praiseroll = -damage
 
-        await self.message(self.channel, "\002{0}\002 (\002{1}\002HP) deals \002{2}\002 damage to \002{3}\002 (\002{4}\002HP)".format(
-            source, sourcehealth, damage, target, self.players[target.lower()]['hp']))
+        line = "\002{0}\002 (\002{1}\002HP) deals \002{2}\002 damage to \002{3}\002 (\002{4}\002HP)".format(
+            source, sourcehealth, damage, target, self.players[target.lower()]['hp'])
+        await self.message(self.channel, line)
+        self.spectate('hit', line)
 
         if self.players[target.lower()]['hp'] <= 0:
             await self.death(target, source)
@@ -562,6 +882,7 @@ class Donger(BaseClient):
 
         self.players[victim.lower()]['hp'] = -1
         await self.message(self.channel, "\002{0}\002 REKT {1}".format(slayer, victim))
+        self.spectate('death', "\002{0}\002 REKT {1}".format(slayer, victim))
 
         if slayer != config['nick']:
             self.countStat(victim, "losses")
@@ -574,7 +895,7 @@ class Donger(BaseClient):
 
     async def start(self, pendingFight):
         self.gameRunning = True
-        self.pendingFights = {}
+        self.clearPendingFights()
         self.deathmatch = pendingFight['deathmatch']
         self.versusone = pendingFight['versusone']
 
@@ -609,16 +930,16 @@ class Donger(BaseClient):
                 self.countStat(player, "deathmatches")
             elif self.versusone:
                 self.countStat(player, "matches")
-            self.accountlist.append(self.users[player.lower()]['account'])
+            self.accountlist.append(self.getAccount(player))
             self.players[player.lower()] = {'hp': 100, 'heals': 5, 'zombie': False, 'nick': player, 'praised': False, 'gdr': 1}
             self.turnlist.append(player)
 
         random.shuffle(self.turnlist)
         await self.ascii("FIGHT")
+        self.spectate('start', "{0} started: {1}".format("Deathmatch" if self.deathmatch else "Duel" if self.versusone else "Fight",
+                                                         " vs ".join("\002{0}\002".format(p) for p in self.turnlist)))
 
-        chunky = self.chunks(self.turnlist, 4)
-        for chunk in chunky:
-            await self.set_mode(self.channel, "+" + "v" * len(chunk), *chunk)
+        await self.massMode(self.channel, "+v", self.turnlist)
 
         # Get the first turn!
         await self.getTurn()
@@ -649,13 +970,24 @@ class Donger(BaseClient):
         if self.players[self.turnlist[self.currentTurn].lower()]['hp'] > 0:  # it's alive!
             self.turnStart = time.time()
             self.poke = False
-            await self.message(self.channel, "It's \002{0}\002's turn.".format(self.turnlist[self.currentTurn]))
+            chance = self.winChance(self.turnlist[self.currentTurn]) if config.get('announce-odds', True) else None
+            await self.message(self.channel, "It's \002{0}\002's turn.{1}".format(self.turnlist[self.currentTurn],
+                                                                              " ({0:.0%} to win)".format(chance) if chance is not None else ""))
             self.players[self.turnlist[self.currentTurn].lower()]['gdr'] = 1
             if self.turnlist[self.currentTurn] == config['nick']:
                 await self.processAI()
         else:  # It's dead, try again.
             await self.getTurn()
 
+    def winChance(self, nick):
+        # Chance that nick (whose turn it is) wins, if it's down to two players and we know the odds
+        alive = [p for p in self.players.values() if p['hp'] > 0]
+        if self.royale or len(alive) != 2 or not self.odds.ready:
+            return None
+        me = self.players[nick.lower()]
+        them = alive[0] if alive[1] is me else alive[1]
+        return self.odds.chance(me['hp'], me['heals'], them['hp'], them['heals'], not self.versusone)
+
     async def processAI(self):
         myself = self.players[config['nick'].lower()]
         # 1 - We will always hit a player with LESS than 25 HP.
@@ -684,6 +1016,8 @@ class Donger(BaseClient):
     async def win(self, winner, realwin=True):
         losers = [self.players[player]['nick'] for player in self.players if self.players[player]['hp'] <= 0]
 
+        self.spectate('win', "\002{0}\002 won{1}".format(self.players[winner]['nick'], "" if realwin else ", everybody else chickened out"))
+
         # Clean everything up.
         await self.set_mode(self.channel, "-mv", winner)
 
@@ -702,38 +1036,58 @@ class Donger(BaseClient):
             self.lastbotfight = time.time()
 
         if self.deathmatch or self.versusone:
-            self.currgamerecord.save()
-            # calculate ELO
-            player1 = PlayerStats.get(PlayerStats.name == self.users[winner]['account'])
-            player2 = PlayerStats.get(PlayerStats.name == self.users[losers[0]]['account'])
+            # The game, the new ratings and the head-to-head record go in together
+            with database.atomic():
+                self.currgamerecord.save()
+                # calculate ELO
+                player1 = PlayerStats.get(PlayerStats.name == self.getAccount(winner))
+                player2 = PlayerStats.get(PlayerStats.name == self.getAccount(losers[0]))
 
-            r1 = 10 ** (player1.elo / 400)
-            r2 = 10 ** (player2.elo / 400)
+                r1 = 10 ** (player1.elo / 400)
+                r2 = 10 ** (player2.elo / 400)
 
-            e1 = r1 / (r1 + r2)
-            e2 = r2 / (r1 + r2)
+                e1 = r1 / (r1 + r2)
+                e2 = r2 / (r1 + r2)
 
-            k1 = 30 if (player1.matches + player1.deathmatches) < 20 else 20
-            k2 = 30 if (player2.matches + player2.deathmatches) < 20 else 20
+                k1 = 30 if (player1.matches + player1.deathmatches) < 20 else 20
+                k2 = 30 if (player2.matches + player2.deathmatches) < 20 else 20
 
-            if self.deathmatch:
-                k1 += 5
-                k2 += 5
+                if self.deathmatch:
+                    k1 += 5
+                    k2 += 5
+
+                player1.elo = int(round(player1.elo + k1 * (1 - e1), 0))
+                player2.elo = int(round(player2.elo + k2 * (0 - e2), 0))
+                player1.save()
+                player2.save()
+
+                if self.currgamerecord.player1.lower() == self.players[winner]['nick'].lower():
+                    damage = (self.currgamerecord.player1_totdmg, self.currgamerecord.player2_totdmg)
+                else:
+                    damage = (self.currgamerecord.player2_totdmg, self.currgamerecord.player1_totdmg)
+                HeadToHead.record(player1.name, player2.name, *damage)
+                self.rollupGame()
+            self.recentgames.appendleft(self.gameDict(self.currgamerecord))
+            self.invalidateStats(player1.name, True)
+            self.invalidateStats(player2.name, True)
+            self.statscache.invalidate(('h2h',) + HeadToHead.pair(player1.name, player2.name))
 
-            player1.elo = int(round(player1.elo + k1 * (1 - e1), 0))
-            player2.elo = int(round(player2.elo + k2 * (0 - e2), 0))
-            player1.save()
-            player2.save()
+        self.resetGame()
 
+    def resetGame(self):
         # Reset fight-related variables
         self.deathmatch = False
         self.versusone = False
+        self.royale = False
         self.gameRunning = False
         self.turnStart = 0
         self.players = {}
         self.turnlist = []
         self.accountlist = []
+        self.gamecounts = {}
         self.currentTurn = -1
+        self.royaleRound = 0
+        self.royaleActions = {}
 
     async def ascii(self, key, font='smslant', lineformat=""):
         try:
@@ -761,8 +1115,12 @@ class Donger(BaseClient):
                 ch['users'].discard(user)
                 ch['users'].add(new)
 
-    async def fight(self, players, deathmatch=False, versusone=False):
-        # Check if those users are in the channel, if they're identified, etc
+    async def fight(self, players, deathmatch=False, versusone=False, resolved=None):
+        # Check if those users are in the channel, if they're identified, etc. resolved is
+        # resolveAccounts() for the ones that are here, if the caller already has it.
+        if resolved is None:
+            here = set(map(str.lower, self.channels[self.channel]['users']))
+            resolved = await self.resolveAccounts([x for x in players if x != "*" and x.lower() in here])
         accounts = []
         openSpots = 0
         for player in players[:]:
@@ -774,27 +1132,28 @@ class Donger(BaseClient):
                 await self.message(self.channel, "\002{0}\002 is not in the channel.".format(player))
                 return
 
-            if not self.users[player]['account']:
+            if not resolved[player]:
                 await self.message(self.channel, "\002{0}\002 is not identified with NickServ.".format(player))
                 return
 
-            if self.users[player]['account'] in accounts:
+            if resolved[player] in accounts:
                 players.remove(player)
                 continue
 
-            accounts.append(self.users[player]['account'])  # This is kinda to prevent clones playing
+            accounts.append(resolved[player])  # This is kinda to prevent clones playing
 
         if len(players) <= 1:
             await self.message(self.channel, "You need more than one person to fight!")
             return
 
-        self.pendingFights[players[0].lower()] = {
+        fight = self.addPendingFight(players[0], {
             'ts': time.time(),  # Used to calculate the expiry time for a fight
             'deathmatch': deathmatch,
             'versusone': versusone,
-            'pendingaccept': [x.lower() for x in players[1:]],
+            'pendingaccept': {x.lower() for x in players[1:] if x != '*'},
+            'openspots': openSpots,
             'players': [players[0]],
-        }
+        })
 
         if config['nick'] in players:  # If a user is requesting the bot participate in a fight...
             if versusone:  # If it's a duel or deathmatch, refuse
@@ -802,11 +1161,10 @@ class Donger(BaseClient):
             if (time.time() - self.lastbotfight < 30):  # Prevent the bot from fighting with someone within 30 seconds of its last fight with someone. Trying to stop people from taking over the channel
                 return await self.message(self.channel, "{0} needs a 30 second break before participating in a fight.".format(config['nick']))
             await self.message(self.channel, "YOU WILL SEE")
-            self.pendingFights[players[0].lower()]['pendingaccept'].remove(config['nick'].lower())
-            self.pendingFights[players[0].lower()]['players'].append(config['nick'])
-            if not self.pendingFights[players[0].lower()]['pendingaccept']:
+            self.takeSpot(players[0].lower(), config['nick'])
+            if not fight['pendingaccept'] and not fight['openspots']:
                 # Start the game!
-                await self.start(self.pendingFights[players[0].lower()])
+                await self.start(fight)
                 return
             players.remove(config['nick'])
 
@@ -825,20 +1183,262 @@ class Donger(BaseClient):
         elif openSpots > 1:
             await self.message(self.channel, "This fight has open spots for {0} players to join.".format(openSpots))
 
+    def addPendingFight(self, challenger, fight):
+        self.dropPendingFight(challenger.lower())  # A new challenge replaces the old one (and goes to the back of the line)
+        self.pendingFights[challenger.lower()] = fight
+        for challengee in fight['pendingaccept']:
+            self.challenges.setdefault(challengee, {})[challenger.lower()] = True
+        if fight['openspots']:
+            self.openFights[challenger.lower()] = True
+        return fight
+
+    def dropPendingFight(self, challenger):
+        fight = self.pendingFights.pop(challenger, None)
+        if fight:
+            for challengee in fight['pendingaccept']:
+                self.unindexChallenge(challenger, challengee)
+            self.openFights.pop(challenger, None)
+        return fight
+
+    def unindexChallenge(self, challenger, challengee):
+        challengers = self.challenges.get(challengee.lower(), {})
+        challengers.pop(challenger, None)
+        if not challengers:
+            self.challenges.pop(challengee.lower(), None)
+
+    def takeSpot(self, challenger, nick):
+        # nick accepted challenger's fight, either because they were challenged or through an open spot
+        fight = self.pendingFights[challenger]
+        fight['players'].append(nick)
+        if nick.lower() in fight['pendingaccept']:
+            fight['pendingaccept'].discard(nick.lower())
+            self.unindexChallenge(challenger, nick)
+        else:
+            fight['openspots'] -= 1
+            if not fight['openspots']:
+                self.openFights.pop(challenger, None)
+
+    def clearPendingFights(self):
+        self.pendingFights = {}
+        self.challenges = {}
+        self.openFights.clear()
+
+    async def royaleStart(self):
+        signup = self.royaleSignup
+        self.royaleSignup = None
+
+        if len(signup['players']) < config.get('royale-min-players', 3):
+            await self.message(self.channel, "Not enough dongers showed up for the battle royale ({0} signed up).".format(len(signup['players'])))
+            return
+
+        self.gameRunning = True
+        self.royale = True
+        self.clearPendingFights()
+
+        await self.set_mode(self.channel, "+m")
+        await self.ascii("ROYALE", font="fire_font-s", lineformat="\00304")
+        await self.message(self.channel, "RULES:")
+        await self.message(self.channel, "1. \002{0}\002 dongers enter, one donger leaves.".format(len(signup['players'])))
+        await self.message(self.channel, "2. Every round lasts {0} seconds and everybody acts at the same time. Use !hit [nick] or !heal once per round.".format(config.get('royale-round', 30)))
+        await self.message(self.channel, "3. Sit out two rounds in a row and you're out.")
+
+        for player in signup['players']:
+            self.players[player.lower()] = {'hp': 100, 'heals': 5, 'zombie': False, 'nick': player, 'praised': False, 'gdr': 1, 'idle': 0}
+            self.turnlist.append(player)
+        self.accountlist = signup['accounts']
+        self.spectate('start', "Battle royale started with \002{0}\002 dongers".format(len(self.turnlist)))
+
+        await self.massMode(self.channel, "+v", self.turnlist)
+        await self.royaleNextRound()
+
+    async def royaleNextRound(self):
+        if not self.royale:  # Ended while the round was being resolved
+            return
+        self.royaleRound += 1
+        self.royaleActions = {}
+        self.turnStart = time.time()
+        alive = [p for p in self.players if self.players[p]['hp'] > 0]
+        await self.message(self.channel, "\002ROUND {0}\002: {1} dongers left. You have {2} seconds.".format(self.royaleRound, len(alive), config.get('royale-round', 30)))
+
+    async def royaleAction(self, source, command, args):
+        # Errors go by notice, the channel is busy enough as it is.
+        player = self.players.get(source.lower())
+        if not player or player['hp'] <= 0 or not self.turnStart:  # turnStart is 0 while a round is being resolved
+            return
+        if source.lower() in self.royaleActions:
+            return await self.notice(source, "You already picked your move for this round.")
+
+        if command == "heal":
+            if not player['heals']:
+                return await self.notice(source, "You can't heal this round, go hit somebody.")
+            self.royaleActions[source.lower()] = ('heal', None)
+        else:
+            victim = None
+            if args:
+                victim = args[0].lower()
+                if victim == source.lower():
+                    return await self.notice(source, "Stop hitting yourself!")
+                if victim not in self.players or self.players[victim]['hp'] <= 0:
+                    return await self.notice(source, "You should hit something that is actually alive...")
+            self.royaleActions[source.lower()] = ('hit', victim)
+
+        # Everybody made their move, no need to wait for the clock.
+        if self.royaleAllActed():
+            await self.royaleResolve()
+
+    def royaleAllActed(self):
+        # Only the living count, somebody who picked a move and then quit doesn't
+        alive = [p for p in self.players if self.players[p]['hp'] > 0]
+        return bool(alive) and all(p in self.royaleActions for p in alive)
+
+    async def royaleResolve(self):
+        # Everything in a round happens at once: heals land first, then every hit is
+        # applied against the same snapshot of living players.
+        if not self.turnStart:  # Somebody else is already resolving this round
+            return
+        self.turnStart = 0
+
+        alive = [p for p in self.players if self.players[p]['hp'] > 0]
+        cowards = [p for p in self.players if self.players[p].get('coward') and self.players[p]['nick'] in self.turnlist]
+        hits, crits, heals = 0, 0, 0
+        dealt = {}
+
+        for p in alive:
+            action = self.royaleActions.get(p)
+            if not action:
+                self.players[p]['idle'] += 1
+                continue
+            self.players[p]['idle'] = 0
+            if action[0] == 'heal':
+                healing = random.randint(22, 44 - (5 - self.players[p]['heals']) * 4)
+                self.players[p]['hp'] = min(100, self.players[p]['hp'] + healing)
+                self.players[p]['heals'] -= 1
+                heals += 1
+
+        for p in alive:
+            action = self.royaleActions.get(p)
+            if not action or action[0] != 'hit':
+                continue
+            victim = action[1]
+            if not victim or victim not in alive:
+                targets = [x for x in alive if x != p]
+                if not targets:  # Everybody else left
+                    continue
+                victim = random.choice(targets)
+            damage = random.randint(18, 35)
+            if random.randint(1, 12) == 1:
+                damage *= 2
+                crits += 1
+            self.players[victim]['hp'] -= damage
+            self.players[p]['heals'] = 5
+            dealt[p] = dealt.get(p, 0) + damage
+            hits += 1
+
+        idlers = [p for p in alive if self.players[p]['idle'] >= 2 and self.players[p]['hp'] > 0]
+        for p in idlers:
+            self.players[p]['hp'] = -1
+
+        dead = [p for p in alive if self.players[p]['hp'] <= 0] + cowards
+        for p in dead:
+            self.players[p]['hp'] = -1
+            self.turnlist.remove(self.players[p]['nick'])
+        survivors = [p for p in self.players if self.players[p]['hp'] > 0]
+
+        # Condensed round summary: a few lines, no matter how many people are playing.
+        summary = "Round {0}: \002{1}\002 hits (\002{2}\002 crits), \002{3}\002 heals.".format(self.royaleRound, hits, crits, heals)
+        if dealt:
+            brute = max(dealt, key=dealt.get)
+            summary += " Most brutal: \002{0}\002 ({1} damage).".format(self.players[brute]['nick'], dealt[brute])
+        await self.message(self.channel, summary)
+        self.spectate('round', summary)
+        if dead:
+            rekt = "REKT: {0}{1}".format(self.nicklist([self.players[p]['nick'] for p in dead]),
+                                         " ({0} idled out, {1} chickened out)".format(len(idlers), len(cowards)) if idlers or cowards else "")
+            await self.message(self.channel, rekt)
+            self.spectate('death', rekt)
+
+        deadnicks = [self.players[p]['nick'] for p in dead if self.players[p]['nick'] in self.channels[self.channel]['users']]
+        await self.massMode(self.channel, "-v", deadnicks)
+        await self.massKick(self.channel, deadnicks, "REKT")
+
+        if len(survivors) <= 1:
+            await self.royaleEnd(survivors[0] if survivors else None)
+        else:
+            await self.royaleNextRound()
+
+    async def royaleEnd(self, winner):
+        if not self.royale:  # A quit and the end of a round can both get here
+            return
+        self.royale = False
+        self.turnStart = 0
+        entrants = len(self.players)
+        if winner:
+            await self.set_mode(self.channel, "-mv", self.players[winner]['nick'])
+            await self.ascii("WINNER")
+            await self.message(self.channel, "\002{0}\002 is the last donger standing out of {1}!".format(self.players[winner]['nick'], entrants))
+            self.spectate('win', "\002{0}\002 is the last donger standing out of {1}!".format(self.players[winner]['nick'], entrants))
+        else:
+            await self.set_mode(self.channel, "-m")
+            await self.message(self.channel, "Everybody got REKT. Nobody wins the battle royale.")
+            self.spectate('win', "Everybody got REKT. Nobody wins the battle royale.")
+
+        self.resetGame()
+
+    def nicklist(self, nicks, limit=15):
+        """Comma-separated nicks, cut short for the big fights."""
+        if len(nicks) <= limit:
+            return ", ".join(nicks)
+        return "{0} and {1} more".format(", ".join(nicks[:limit]), len(nicks) - limit)
+
     def chunks(self, l, n):
         """Yield successive n-sized chunks from l."""
         for i in range(0, len(l), n):
             yield l[i:i + n]
 
+    async def massMode(self, channel, mode, nicks):
+        # Sets a prefix mode ("+v", "-v", ...) on a bunch of nicks, packing as many into each
+        # MODE line as the server's MODES allows (or as fit in a line, for very generous servers)
+        limit = self._mode_limit or 4
+        batch = []
+        for nick in nicks:
+            if len(batch) == limit or sum(len(n) + 1 for n in batch) + len(nick) > 400:
+                await self.set_mode(channel, mode[0] + mode[1] * len(batch), *batch)
+                batch = []
+            batch.append(nick)
+        if batch:
+            await self.set_mode(channel, mode[0] + mode[1] * len(batch), *batch)
+
+    async def massKick(self, channel, nicks, reason):
+        # Same as massMode, for KICKs. Without a TARGMAX we can only assume one target per KICK.
+        limit = self._target_limits.get('KICK', 1)
+        for chunk in self.chunks(nicks, limit):
+            await self.rawmsg('KICK', channel, ",".join(chunk), reason)
+
     async def _timeout(self):
         while True:
             await asyncio.sleep(5)
 
+            # A bug in there mustn't take the timers down with it (and leave the channel +m for good)
+            try:
+                if self.royale:
+                    if self.turnStart and time.time() - self.turnStart > config.get('royale-round', 30):
+                        await self.royaleResolve()
+                    continue
+
+                if self.royaleSignup and not self.gameRunning and time.time() - self.royaleSignup['ts'] > config.get('royale-signup', 60):
+                    await self.royaleStart()
+            except Exception:
+                logging.exception("Battle royale timer failed")
+                if self.royale and not self.turnStart:  # Stuck halfway through a round, call it off
+                    await self.royaleEnd(None)
+
             if not self.gameRunning or (self.turnStart == 0):
-                for i in copy.copy(self.pendingFights):
-                    if (time.time() - self.pendingFights[i]['ts'] > 300):
-                        await self.message(self.channel, "\002{0}\002's challenge has expired.".format(self.pendingFights[i]['players'][0]))
-                        del self.pendingFights[i]
+                # pendingFights is oldest first, so we only ever look at the ones that expired (and one more)
+                while self.pendingFights:
+                    oldest = next(iter(self.pendingFights))
+                    if time.time() - self.pendingFights[oldest]['ts'] <= 300:
+                        break
+                    await self.message(self.channel, "\002{0}\002's challenge has expired.".format(self.dropPendingFight(oldest)['players'][0]))
                 continue
 
             if (time.time() - self.turnStart > 50) and len(self.turnlist) >= (self.currentTurn + 1):
@@ -862,11 +1462,34 @@ class Donger(BaseClient):
                 self.poke = True
                 await self.message(self.channel, "Wake up, \002{0}\002!".format(self.turnlist[self.currentTurn]))
 
+    async def message(self, target, message, relay=False):
+        if not relay:  # relaySpectators waits for the rest to go first
+            self.lastOutput = time.monotonic()
+        for line in formatting.split(message, self.linelimit("PRIVMSG", target), self.encoding):
+            await self.rawmsg('PRIVMSG', target, line)
+
+    async def notice(self, target, message):
+        self.lastOutput = time.monotonic()
+        for line in formatting.split(message, self.linelimit("NOTICE", target), self.encoding):
+            await self.rawmsg('NOTICE', target, line)
+
+    def linelimit(self, command, target):
+        # Bytes left for text in a line once the server prepends our hostmask. If we don't
+        # know our own username/hostname yet, assume the longest ones.
+        me = self.users.get(self.nickname, {})
+        prefix = ":{0}!{1}@{2} {3} {4} :".format(self.nickname, me.get('username') or "x" * 10, me.get('hostname') or "x" * 63, command, target)
+        return 510 - len(prefix.encode(self.encoding))
+
     async def _send(self, input):
-        await super()._send(input)
-        if not isinstance(input, str):
-            input = input.decode(self.encoding)
-        self.logger.debug('>> %s', input.replace('\r\n', ''))
+        # Not through pydle's _send, that one decodes every line again to log it whether or not
+        # anybody is listening. Encoded once here, and only decoded if the line is really logged.
+        if not isinstance(input, (bytes, str)):
+            input = str(input)
+        if isinstance(input, str):
+            input = input.encode(self.encoding)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('>> %s', WireLine(input, self.encoding))
+        await self.connection.send(input)
 
     # Saves information in the stats database.
     # nick = case-sensitive nick.
@@ -877,9 +1500,8 @@ class Donger(BaseClient):
         if not self.deathmatch and not self.versusone:
             return
 
-        try:
-            nick = self.users[nick]['account']
-        except KeyError:  # User vanished from earth
+        nick = self.getAccount(nick)
+        if not nick:  # User vanished from earth
             return
         try:
             stat = PlayerStats.get(PlayerStats.name == nick)
@@ -887,6 +1509,39 @@ class Donger(BaseClient):
             stat = PlayerStats.create(name=nick)
 
         PlayerStats.update(**{stype: getattr(stat, stype) + add}).where(PlayerStats.name == nick).execute()
+        counts = self.gamecounts.setdefault(nick, {})
+        counts[stype] = counts.get(stype, 0) + add
+        # Match counts decide who gets ranked at all
+        self.invalidateStats(nick, stype in ("matches", "deathmatches"))
+
+    def rollupGame(self):
+        # Add this game's counts to today's rows
+        today = datetime.date.today()
+        total = {'games': 1}
+        for account, counts in self.gamecounts.items():
+            PlayerDaily.add(counts, day=today, name=account)
+            for stat, n in counts.items():
+                total[stat] = total.get(stat, 0) + n
+        total['turns'] = self.currgamerecord.turns  # Not once per player
+        GameDaily.add(total, day=today)
+        self.gamecounts = {}
+
+    def activity(self, days):
+        total = {stat: 0 for stat in DAILY_STATS + ('games',)}
+        for row in GameDaily.select().where(GameDaily.lastdays(days)):
+            for stat in total:
+                total[stat] += getattr(row, stat)
+        played = peewee.fn.SUM(PlayerDaily.matches + PlayerDaily.deathmatches)
+        active = PlayerDaily.select(PlayerDaily.name, played.alias('played')).where(PlayerDaily.lastdays(days)) \
+            .group_by(PlayerDaily.name).order_by(played.desc()).limit(5)
+        return total, [(p.name, p.played) for p in active]
+
+    def invalidateStats(self, account, ranking=False):
+        self.statscache.invalidate(('stats', account.lower()))
+        if ranking:
+            self.statscache.invalidate(('ranking',), ('top',), ('shame',))
+            self.statscache.invalidate_kind('activity')
+            self.statscache.invalidate_kind('api')
 
     def getStats(self, nick):
         try:
@@ -894,6 +1549,133 @@ class Donger(BaseClient):
         except:
             return False
 
+    def startSpectators(self):
+        if config.get('spectator-chans') and not self.spectatorPump:
+            self.spectatorPump = self.eventloop.create_task(self.relaySpectators(), name="spectators")
+
+    async def relaySpectators(self):
+        # Relays the fight to the spectator channels. Everything we send shares the server's flood
+        # limits with the fight itself, so this sends one line every spectator-delay seconds for all
+        # of the channels together (taking turns), and only once the bot has been quiet for that long
+        # and the socket has nothing left to send. If the fight goes faster than that, the hits and
+        # heals get folded into a scoreboard line.
+        delay = config.get('spectator-delay', 1.5)
+        subscribers = collections.deque(self.spectators.subscribe(channel, config.get('spectator-queue', 8), 'condense')
+                                        for channel in config['spectator-chans'])
+        while True:
+            while not any(subscriber.queue for subscriber in subscribers):
+                self.spectators.published.clear()
+                await self.spectators.published.wait()
+
+            # The fight goes first
+            while time.monotonic() - self.lastOutput < delay or self.outputPending():
+                await asyncio.sleep(max(delay - (time.monotonic() - self.lastOutput), 0.1))
+
+            while not subscribers[0].queue:
+                subscribers.rotate(-1)
+            subscriber = subscribers[0]
+            subscribers.rotate(-1)
+            event = subscriber.queue.popleft()
+            if subscriber.name in self.channels:
+                await self.message(subscriber.name, "[{0}] {1}".format(self.channel, event['text']), relay=True)
+                await asyncio.sleep(delay)
+
+    async def liveEvents(self, query):
+        # Server-sent events for the stats API's /live (None makes it send a keepalive)
+        subscriber = self.spectators.subscribe('live', 100, 'drop')
+        try:
+            yield {'type': 'hello', 'fight': self.apiFight(None, query)}
+            while True:
+                yield await subscriber.get(15)
+        finally:
+            self.spectators.unsubscribe(subscriber)
+
+    def outputPending(self):
+        # Bytes we've written that haven't made it out of the socket yet
+        try:
+            return self.connection.writer.transport.get_write_buffer_size()
+        except AttributeError:  # Not connected
+            return 0
+
+    def spectate(self, kind, text):
+        if not self.spectators.subscribers:
+            return
+        self.spectators.publish(kind, text, [{'nick': p['nick'], 'hp': p['hp']} for p in self.players.values() if p['hp'] > 0])
+
+    def startAPI(self):
+        # Started once we're connected (or adopted a connection) so an update's old process has let go of the port by then
+        if config.get('api-port') and not self.api.server:
+            self.eventloop.create_task(self.api.start(config.get('api-host', '127.0.0.1'), config['api-port']))
+
+    # Attributes that belong to this process and aren't handed over to the next one on !update
+    HANDOFF_LOCAL = ('eventloop', 'own_eventloop', 'connection', 'logger', '_pending', '_sasl_client', '_sasl_timer',
+                     'pendingwho', 'statscache', 'profiler', 'api', 'cmds', 'extcmds', 'cmdhelp', 'currgamerecord', 'timeoutTask', 'odds', 'extruntime', 'watchdog', 'spectators', 'spectatorPump', 'lastOutput')
+
+    def handoffState(self):
+        # Stop doing things on our own and pack up for the new process (see handoff.py)
+        self.timeoutTask.cancel()
+        if self.api.server:
+            self.api.server.close()
+            self.api.server = None
+        state = handoff.snapshot(self, self.HANDOFF_LOCAL)
+        if self.currgamerecord:
+            self.currgamerecord.save()
+            state['currgamerecord'] = self.currgamerecord.id
+        return state
+
+    def restoreState(self, state):
+        record = state.pop('currgamerecord', None)
+        handoff.restore(self, state)
+        self.currgamerecord = GameStats.get(GameStats.id == record) if record else None
+        self.startAPI()
+        self.startSpectators()
+
+    def cancelHandoff(self):
+        self.timeoutTask = self.eventloop.create_task(self._timeout(), name="timers")
+        self.startAPI()
+
+    def gameDict(self, game):
+        return {field: getattr(game, field) for field in GameStats._meta.sorted_field_names}
+
+    # Stats API endpoints (see statsapi.py). These return plain JSON-able data.
+    def apiLeaderboard(self, rest, query):
+        players = self.top_dongers(query['order'] == 'shame').limit(query['limit'])
+        return [{'rank': index + 1, 'name': p.name, 'elo': p.elo, 'decayed': p.decayed(), 'wins': p.wins, 'losses': p.losses,
+                 'matches': p.matches, 'deathmatches': p.deathmatches} for index, p in enumerate(players)]
+
+    def apiPlayer(self, name, query):
+        stats = self.statscache.get(('stats', name.lower()), lambda: self.getStats(name))
+        if not stats:
+            raise statsapi.NotFound(name)
+        ranking = self.statscache.get(('ranking',), lambda: {d['name'].lower(): index + 1 for (index, d) in enumerate(self.top_dongers().dicts())})
+        player = {field: getattr(stats, field) for field in PlayerStats._meta.sorted_field_names if field != 'decaykey'}
+        player.update(rank=ranking.get(stats.name.lower()), decayed=stats.decayed())
+        return player
+
+    def apiGames(self, rest, query):
+        return list(self.recentgames)
+
+    def apiDaily(self, name, query):
+        # Per-day totals for charts, everybody's or (on /daily/<account>) one player's
+        model = PlayerDaily if name else GameDaily
+        rows = model.select().where(model.lastdays(query['days']))
+        if name:
+            rows = rows.where(PlayerDaily.name ** name)
+        return [{field: getattr(row, field) for field in model._meta.sorted_field_names if field not in ('id', 'name')}
+                for row in rows.order_by(model.day)]
+
+    def apiFight(self, rest, query):
+        fight = {'running': self.gameRunning, 'signup': self.royaleSignup['players'] if self.royaleSignup else None}
+        if self.gameRunning:
+            fight['mode'] = 'royale' if self.royale else 'deathmatch' if self.deathmatch else 'duel' if self.versusone else 'fight'
+            fight['players'] = [{'nick': nick, 'hp': max(self.players[nick.lower()]['hp'], 0), 'heals': self.players[nick.lower()]['heals']}
+                                for nick in self.turnlist]
+            if self.royale:
+                fight['round'] = self.royaleRound
+            elif 0 <= self.currentTurn < len(self.turnlist):
+                fight['turn'] = self.turnlist[self.currentTurn]
+        return fight
+
     def import_extcmds(self):
         self.cmdhelp = {}
         try:
@@ -903,6 +1685,7 @@ class Donger(BaseClient):
             logging.warning("No extended commands found in config.json")
         logging.info("Beginning extended command tests")
         self.cmds = {}
+        self.extruntime = extruntime.Runtime(self.eventloop, config.get('extcmd-policy'))
         for command in self.extcmds:
             try:  # Let's test these on start...
                 cmd = importlib.import_module('extcmd.{}'.format(command))
@@ -913,8 +1696,9 @@ class Donger(BaseClient):
                 except AttributeError:
                     logging.warning('No helptext provided for command {}'.format(command))
                     self.cmdhelp[command] = 'A mystery'
+                self.extruntime.add(command, cmd)
                 self.cmds[command] = cmd
-            except ImportError:
+            except (ImportError, ValueError):
                 logging.warning("Failed to import specified extended command: {}".format(command))
                 self.extcmds.remove(command)
                 logging.warning("Removed command {} from list of available commands. You should fix config.json to remove it from there, too (or just fix the module).".format(command))
@@ -922,8 +1706,9 @@ class Donger(BaseClient):
 
 
 # Database stuff
+ELO_DECAY = 2  # ELO points lost for every day without playing, for the decayed leaderboard
+
 database = peewee.SqliteDatabase('dongerdong.db')
-database.connect()
 
 
 class BaseModel(peewee.Model):
@@ -955,14 +1740,35 @@ class PlayerStats(BaseModel):
     firstplayed = peewee.DateTimeField(default=datetime.datetime.now)
     lastplayed = peewee.DateTimeField()
 
+    # Decayed ELO is elo - ELO_DECAY * (days since lastplayed). That's the same as
+    # (elo + ELO_DECAY * lastplayed day) - ELO_DECAY * today, and the part in parentheses only
+    # changes when the player does. So we store that, index it, and sort the decayed leaderboard
+    # by it without ever rewriting anybody's rating.
+    decaykey = peewee.IntegerField(default=0)
+
     def save(self, *args, **kwargs):
         self.lastplayed = datetime.datetime.now()
+        self.decaykey = self.elo + ELO_DECAY * self.lastplayed.toordinal()
         return super(PlayerStats, self).save(*args, **kwargs)
 
+    def decayed(self):
+        return self.decaykey - ELO_DECAY * datetime.date.today().toordinal()
+
     @classmethod
     def custom_init(cls):
         database.execute_sql('create unique index if not exists playerstats_unique '
                              'on playerstats(name collate nocase)', {})
+        database.execute_sql('create index if not exists playerstats_decay '
+                             'on playerstats(decaykey)', {})
+
+    @classmethod
+    def migrate(cls):
+        # Databases from before the decayed leaderboard need the column and everybody's key.
+        # 1721424.5 is the julian day of date.fromordinal(0), so this is the same as toordinal()
+        if 'decaykey' not in [column.name for column in database.get_columns('playerstats')]:
+            migrate(SqliteMigrator(database).add_column('playerstats', 'decaykey', cls.decaykey))
+            database.execute_sql('update playerstats set decaykey = elo + ? * '
+                                 'cast(julianday(substr(lastplayed, 1, 10)) - 1721424.5 as integer)', (ELO_DECAY,))
 
 
 class GameStats(BaseModel):
@@ -1000,16 +1806,185 @@ class GameStats(BaseModel):
                              'on gamestats(player1 collate nocase, player2 collate nocase)', {})
 
 
-PlayerStats.create_table(True)
-GameStats.create_table(True)
+class HeadToHead(BaseModel):
+    # Pairwise records for duels and deathmatches, one row per pair of accounts.
+    # player1 is always the one that comes first alphabetically (lowercased).
+    player1 = peewee.CharField()
+    player2 = peewee.CharField()
+
+    games = peewee.IntegerField(default=0)
+    player1_wins = peewee.IntegerField(default=0)
+    player2_wins = peewee.IntegerField(default=0)
+    player1_totdmg = peewee.IntegerField(default=0)
+    player2_totdmg = peewee.IntegerField(default=0)
+
+    lastplayed = peewee.DateTimeField(default=datetime.datetime.now)
 
-try:
-    PlayerStats.custom_init()
-    GameStats.custom_init()
-except:
-    pass
+    @staticmethod
+    def pair(a, b):
+        return tuple(sorted((a.lower(), b.lower())))
 
+    @classmethod
+    def lookup(cls, player1, player2):
+        try:
+            return cls.get((cls.player1 == player1) & (cls.player2 == player2))
+        except cls.DoesNotExist:
+            return False
 
-client = Donger(config['nick'], sasl_username=config['nickserv_username'],
-                sasl_password=config['nickserv_password'])
-client.run(config['server'], config['port'], tls=config['tls'])
+    @classmethod
+    def record(cls, winner, loser, winnerdmg, loserdmg):
+        player1, player2 = cls.pair(winner, loser)
+        if not cls.lookup(player1, player2):
+            cls.create(player1=player1, player2=player2)
+
+        if player1 == winner.lower():
+            changes = {'player1_wins': cls.player1_wins + 1, 'player1_totdmg': cls.player1_totdmg + winnerdmg,
+                       'player2_totdmg': cls.player2_totdmg + loserdmg}
+        else:
+            changes = {'player2_wins': cls.player2_wins + 1, 'player2_totdmg': cls.player2_totdmg + winnerdmg,
+                       'player1_totdmg': cls.player1_totdmg + loserdmg}
+        cls.update(games=cls.games + 1, lastplayed=datetime.datetime.now(), **changes) \
+            .where((cls.player1 == player1) & (cls.player2 == player2)).execute()
+
+    @classmethod
+    def backfill(cls):
+        # One-time job for the games played before this table existed. Those only have the
+        # nicks people used to challenge each other, which is the best we've got.
+        pairs = {}
+        for game in GameStats.select().where(GameStats.winner != 0).order_by(GameStats.time):  # Not the unfinished ones
+            key = cls.pair(game.player1, game.player2)
+            row = pairs.setdefault(key, {'player1': key[0], 'player2': key[1], 'games': 0, 'player1_wins': 0, 'player2_wins': 0,
+                                         'player1_totdmg': 0, 'player2_totdmg': 0, 'lastplayed': game.time})
+            flipped = key[0] != game.player1.lower()
+            row['games'] += 1
+            row['player2_totdmg' if flipped else 'player1_totdmg'] += game.player1_totdmg
+            row['player1_totdmg' if flipped else 'player2_totdmg'] += game.player2_totdmg
+            if game.winner in (1, 2):
+                row['player{0}_wins'.format(game.winner if not flipped else 3 - game.winner)] += 1
+            row['lastplayed'] = game.time
+
+        with database.atomic():
+            for row in pairs.values():
+                cls.create(**row)
+        logging.info("Backfilled head-to-head records for {0} pairs".format(len(pairs)))
+
+    @classmethod
+    def custom_init(cls):
+        database.execute_sql('create unique index if not exists headtohead_unique '
+                             'on headtohead(player1, player2)', {})
+
+
+# What countStat counts, and so what the daily rollups add up
+DAILY_STATS = ('matches', 'deathmatches', 'wins', 'losses', 'quits', 'idleouts', 'turns',
+               'hits', 'heals', 'praises', 'totdmg', 'totheal', 'crits')
+
+
+class DailyStats(BaseModel):
+    # Per-day totals, added to at the end of every game. Anything like "games this week" or
+    # "crit rate this month" adds up a few of these rows instead of going through GameStats.
+    day = peewee.DateField()
+
+    matches = peewee.IntegerField(default=0)
+    deathmatches = peewee.IntegerField(default=0)
+    wins = peewee.IntegerField(default=0)
+    losses = peewee.IntegerField(default=0)
+    quits = peewee.IntegerField(default=0)
+    idleouts = peewee.IntegerField(default=0)
+    turns = peewee.IntegerField(default=0)
+    hits = peewee.IntegerField(default=0)
+    heals = peewee.IntegerField(default=0)
+    praises = peewee.IntegerField(default=0)
+    totdmg = peewee.IntegerField(default=0)
+    totheal = peewee.IntegerField(default=0)
+    crits = peewee.IntegerField(default=0)
+
+    @classmethod
+    def key(cls, **where):
+        clause = None
+        for field, value in where.items():
+            clause = (getattr(cls, field) == value) if clause is None else clause & (getattr(cls, field) == value)
+        return clause
+
+    @classmethod
+    def add(cls, counts, **where):
+        if not cls.select().where(cls.key(**where)).exists():
+            cls.create(**where)
+        cls.update(**{stat: getattr(cls, stat) + n for stat, n in counts.items()}).where(cls.key(**where)).execute()
+
+    @classmethod
+    def lastdays(cls, days):
+        # Where clause for the last `days` days, today included
+        return cls.day > datetime.date.today() - datetime.timedelta(days=days)
+
+
+class PlayerDaily(DailyStats):
+    # One row per account per day
+    name = peewee.CharField()
+
+    @classmethod
+    def custom_init(cls):
+        database.execute_sql('create unique index if not exists playerdaily_unique '
+                             'on playerdaily(day, name)', {})
+
+
+class GameDaily(DailyStats):
+    # Everybody's totals, one row per day. games counts the games themselves (matches and
+    # deathmatches count players, so they're twice as much for a duel).
+    games = peewee.IntegerField(default=0)
+
+    @classmethod
+    def custom_init(cls):
+        database.execute_sql('create unique index if not exists gamedaily_unique '
+                             'on gamedaily(day)', {})
+
+    @classmethod
+    def backfill(cls):
+        # One-time job for the history from before the rollups, see daily.py
+        games, players = daily.rows(GameStats.select().order_by(GameStats.time))
+        with database.atomic():
+            for row in games:
+                cls.create(**row)
+            for row in players:
+                PlayerDaily.create(**row)
+        logging.info("Backfilled daily stats for {0} days".format(len(games)))
+
+
+def setupDatabase():
+    database.connect()
+    PlayerStats.create_table(True)
+    PlayerStats.migrate()
+    GameStats.create_table(True)
+    backfillHeadToHead = not HeadToHead.table_exists()
+    HeadToHead.create_table(True)
+    backfillDaily = not GameDaily.table_exists()
+    PlayerDaily.create_table(True)
+    GameDaily.create_table(True)
+
+    try:
+        PlayerStats.custom_init()
+        GameStats.custom_init()
+        HeadToHead.custom_init()
+        PlayerDaily.custom_init()
+        GameDaily.custom_init()
+    except:
+        pass
+
+    if backfillHeadToHead:
+        HeadToHead.backfill()
+    if backfillDaily:
+        GameDaily.backfill()
+
+
+# The extended commands' pool processes import this file again (see extruntime.py), that mustn't
+# start another bot, log listener or file handler, or touch the database
+if __name__ == "__main__":
+    setupLogging()
+    setupDatabase()
+
+    client = Donger(config['nick'], sasl_username=config['nickserv_username'],
+                    sasl_password=config['nickserv_password'])
+    if os.environ.get(handoff.ENV):  # Started by !update, the old process is waiting to give us its connection
+        client.eventloop.run_until_complete(handoff.adopt(client, os.environ.pop(handoff.ENV)))
+        client.eventloop.run_forever()
+    else:
+        client.run(config['server'], config['port'], tls=config['tls'])
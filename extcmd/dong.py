@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
-import json
-import random
-helptext = "Produces a genuine, authentic donger"
+import wisdomstore
+helptext = "Produces a genuine, authentic donger. !dong <word> finds one that matches"
 
-dongerlist = json.load(open("wisdom/dongers.json", 'r', encoding='utf-8'))
-async def doit(irc, target, source):
-  await irc.message(target, random.choice(dongerlist))
+dongers = wisdomstore.load("wisdom/dongers.json")
+async def doit(irc, target, source, args):
+  donger = dongers.random(args)
+  await irc.message(target, donger if donger else "No donger matches that. Maybe you should make one.")
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
-import json
-import random
-helptext = "Outputs a random BOFH excuse."
+import wisdomstore
+helptext = "Outputs a random BOFH excuse. !excuse <word> finds one that matches"
 
-excuselist = json.load(open("wisdom/excuses.json"))
-async def doit(irc, target, source):
-  await irc.message(target, random.choice(excuselist))
+excuses = wisdomstore.load("wisdom/excuses.json")
+async def doit(irc, target, source, args):
+  excuse = excuses.random(args)
+  await irc.message(target, excuse if excuse else "No excuse for that. Must be solar flares.")
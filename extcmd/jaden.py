@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
-import json
-import random
-helptext = "Outputs a random tweet from Jaden Smith."
+import wisdomstore
+helptext = "Outputs a random tweet from Jaden Smith. !jaden <word> finds one that matches"
 
-jadenlist = json.load(open("wisdom/jaden.json", 'r', encoding='utf-8'))
-async def doit(irc, target, source):
-  await irc.message(target, random.choice(jadenlist))
+tweets = wisdomstore.load("wisdom/jaden.json")
+async def doit(irc, target, source, args):
+  tweet = tweets.random(args)
+  await irc.message(target, tweet if tweet else "Jaden Hasn't Tweeted About That Yet.")
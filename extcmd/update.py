@@ -1,25 +1,75 @@
-import subprocess
+import asyncio
 import os
+import subprocess
 import sys
 import time
 
+import handoff
+
 helptext = "Updates and restarts the bot"
 adminonly = True
+timeout = None  # It waits for the new process itself, and mustn't be interrupted halfway through a handoff
+maxconcurrent = 1
+
+
+async def report(irc, source, *command):
+    child = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                 stderr=asyncio.subprocess.STDOUT)
+    out, _ = await child.communicate()
+
+    await irc.message(source, "{0} returned code {1}".format(" ".join(command), child.returncode))
+    for line in out.decode("utf-8", "replace").splitlines():
+        await irc.message(source, line)
+    return child.returncode == 0
+
+
+async def output(*command):
+    child = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                 stderr=asyncio.subprocess.DEVNULL)
+    out, _ = await child.communicate()
+    return out.decode("utf-8", "replace").splitlines()
+
+
+async def doit(irc, target, source, args):
+    before = (await output("git", "rev-parse", "HEAD"))[0]
+    # --preserve-merges is gone from git, --rebase-merges is what replaced it
+    for command in (["git", "fetch"], ["git", "rebase", "--stat", "--rebase-merges"]):
+        if not await report(irc, source, *command):
+            return await irc.message(source, "Not restarting.")
+
+    # Don't restart into something that won't even start: the bot itself and every module the
+    # update touched (helpers and extended commands only get imported by the new process)
+    changed = await output("git", "diff", "--name-only", "--diff-filter=d", before, "HEAD", "--", "*.py")
+    files = [sys.argv[0]] + [name for name in changed if not os.path.samefile(name, sys.argv[0])]
+    if not await report(irc, source, sys.executable, "-m", "py_compile", *files):
+        return await irc.message(source, "Not restarting.")
+
+    if irc.connection.tls:  # Can't hand TLS sessions over, see handoff.py
+        await irc.quit("Updating...")
+        os.execl(sys.executable, sys.executable, *sys.argv)
+
+    # Start the new version next to this one and give it our connection once it's ready
+    listener, path = handoff.listen()
+    # (A plain Popen, asyncio would kill the child when this process goes away)
+    child = subprocess.Popen([sys.executable] + sys.argv, env=dict(os.environ, **{handoff.ENV: path}),
+                             start_new_session=True)
+    accepted = asyncio.ensure_future(irc.eventloop.sock_accept(listener))
+    started = time.time()
+    while not accepted.done() and child.poll() is None and time.time() - started < 120:
+        await asyncio.wait([accepted], timeout=1)
+    handoff.close(listener, path)
+
+    if not accepted.done():
+        accepted.cancel()
+        if child.poll() is None:
+            child.kill()
+        return await irc.message(source, "The new version didn't come up, so I'm staying.")
 
-async def doit(irc, target, source):
-    commands = ["git fetch",
-                "git rebase --stat --preserve-merges"]
-    
-    for command in commands:
-        child = subprocess.Popen(command.split(),
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-        (out, err) = child.communicate()
-        ret = child.returncode
-        
-        async irc.message(source, "{0} returned code {1}".format(command, ret))
-        for line in (out + err).splitlines():
-            async irc.message(source, line.decode("utf-8"))
-    
-    irc.eventloop.schedule(irc.quit, "Updating...")
-    irc.eventloop.schedule(os.execl, sys.executable, sys.executable, *sys.argv)
+    await irc.message(source, "Handing over to the new version (pid {0})...".format(child.pid))
+    conn, _ = accepted.result()
+    if await handoff.handover(irc, conn):
+        irc.eventloop.stop()
+    else:
+        await irc.message(source, "The new version didn't take over, so I'm staying.")
+        if child.poll() is None:
+            child.kill()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Runs the extended commands (extcmd/*) so a slow or stuck one can't freeze the bot. Every command
+# gets a policy, from module attributes that can be overridden with the extcmd-policy setting:
+#
+#   runin = "inline"     # await doit(irc, target, source, args) on the event loop (default)
+#           "thread"     # call run(args) in a thread and send whatever it returns
+#           "process"    # same, in a separate process, for the really CPU hungry ones
+#   timeout = 10         # Seconds before we give up on it (None for no limit)
+#   maxconcurrent = 2    # Invocations allowed at the same time, the rest are turned away
+#
+# A thread or process that times out can't be stopped, so it keeps its slot until it's done.
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import importlib
+import io
+import logging
+import multiprocessing
+import time
+import traceback
+
+DEFAULTS = {'runin': 'inline', 'timeout': 10, 'maxconcurrent': 2}
+
+
+class WorkerError(Exception):
+    pass
+
+
+class Capture(logging.Handler):
+    # Collects a worker's log records, to be sent back with the result
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append((record.levelno, record.name, self.format(record)))
+
+
+def work(name, args):
+    """
+    Runs extcmd.<name>'s run(args) in a pool process. Returns (result, logged, error): logged is
+    everything it logged or printed as (level, logger, message), error a traceback if it blew up.
+    """
+    capture = Capture()
+    logging.getLogger().handlers = [capture]  # Nothing in here drains the bot's log queue
+    out = io.StringIO()
+    result = error = None
+    try:
+        with contextlib.redirect_stdout(out):
+            result = importlib.import_module('extcmd.' + name).run(args)
+    except Exception:
+        error = traceback.format_exc()
+    capture.lines.extend((logging.INFO, 'extcmd.' + name, line) for line in out.getvalue().splitlines())
+    return result, capture.lines, error
+
+
+class Plugin:
+    def __init__(self, name, module, policy):
+        self.name = name
+        self.module = module
+        self.runin = policy['runin']
+        self.timeout = policy['timeout']
+        self.maxconcurrent = policy['maxconcurrent']
+        self.running = 0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.latencies = collections.deque(maxlen=500)  # Seconds, most recent calls
+
+    def done(self):
+        self.running -= 1
+
+    def summary(self):
+        line = "{0} ({1}): {2} calls".format(self.name, self.runin, self.calls)
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            line += ", p50 {0:.0f}ms, p95 {1:.0f}ms, max {2:.0f}ms".format(latencies[len(latencies) // 2] * 1000,
+                                                                        latencies[int(len(latencies) * 0.95)] * 1000,
+                                                                        latencies[-1] * 1000)
+        return line + ", {0} timeouts, {1} errors, {2} turned away".format(self.timeouts, self.errors, self.rejected)
+
+
+class Runtime:
+    def __init__(self, loop, overrides=None, threads=4, processes=2):
+        self.loop = loop
+        self.overrides = overrides or {}
+        self.plugins = {}
+        self.threads = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="extcmd")
+        self.processcount = processes
+        self.processes = None  # Started the first time a command needs it
+
+    def add(self, name, module):
+        policy = dict(DEFAULTS)
+        for key in DEFAULTS:
+            if hasattr(module, key):
+                policy[key] = getattr(module, key)
+        policy.update(self.overrides.get(name, {}))
+        if policy['runin'] not in ('inline', 'thread', 'process'):
+            raise ValueError("{0}: runin has to be inline, thread or process".format(name))
+        if policy['runin'] != 'inline' and not hasattr(module, 'run'):
+            raise ValueError("{0}: needs a run(args) function to run in a {1}".format(name, policy['runin']))
+        self.plugins[name] = Plugin(name, module, policy)
+
+    def pool(self):
+        if self.processes is None:
+            # Not fork: the bot has the log listener, the watchdog and the thread pool running, and a
+            # forked copy gets those threads' locks but not the threads. The forkserver is a fresh
+            # process that imports dongerdong.py once, which only defines things (the bot, the log
+            # listener and the database are set up under __main__), so it has no threads to fork
+            # with, and the workers import the commands themselves.
+            self.processes = concurrent.futures.ProcessPoolExecutor(self.processcount, mp_context=multiprocessing.get_context('forkserver'))
+        return self.processes
+
+    async def run(self, name, irc, target, source, args):
+        plugin = self.plugins[name]
+        if plugin.running >= plugin.maxconcurrent:
+            plugin.rejected += 1
+            logging.info("Turned away {0}'s !{1}, {2} already running".format(source, name, plugin.running))
+            return
+
+        plugin.running += 1
+        plugin.calls += 1
+        started = time.perf_counter()
+        try:
+            if plugin.runin == 'inline':
+                try:
+                    await asyncio.wait_for(plugin.module.doit(irc, target, source, args), plugin.timeout)
+                finally:
+                    plugin.done()
+            else:
+                try:
+                    if plugin.runin == 'process':
+                        future = self.pool().submit(work, name, args)
+                    else:
+                        future = self.threads.submit(plugin.module.run, args)
+                except Exception:
+                    plugin.done()
+                    raise
+                future.add_done_callback(lambda f: self.loop.call_soon_threadsafe(plugin.done))
+                result = await asyncio.wait_for(asyncio.wrap_future(future, loop=self.loop), plugin.timeout)
+                if plugin.runin == 'process':
+                    result, logged, error = result
+                    for level, logger, message in logged:
+                        logging.getLogger(logger).log(level, "(worker) {0}".format(message))
+                    if error:
+                        raise WorkerError(error)
+                if result:
+                    await irc.message(target, result)
+        except asyncio.TimeoutError:
+            plugin.timeouts += 1
+            logging.warning("!{0} took longer than {1} seconds, gave up on it".format(name, plugin.timeout))
+        except Exception as e:
+            plugin.errors += 1
+            logging.exception("!{0} blew up".format(name))
+            if isinstance(e, concurrent.futures.BrokenExecutor) and plugin.runin == 'process':
+                self.processes = None  # A worker died, start over with a new pool next time
+        plugin.latencies.append(time.perf_counter() - started)
+
+    def report(self, names=None):
+        return [self.plugins[name].summary() for name in (names or self.plugins) if name in self.plugins]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Splits outgoing text into lines that fit in a single IRC message. pydle counts characters,
+# which goes horribly wrong with dongers (three bytes per ຈ), so we count UTF-8 bytes instead.
+import functools
+import re
+import unicodedata
+
+# Things that must never be cut in half: color codes with their numbers, hex colors,
+# the single-byte formatting toggles and, well, any other character.
+ATOMS = re.compile(r"\x03(?:\d{1,2}(?:,\d{1,2})?)?"
+                   r"|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?"
+                   r"|.", re.S)
+
+
+def glue(char):
+    """True if the character belongs to the one before it (combining marks, joiners, variation selectors)."""
+    return unicodedata.combining(char) or unicodedata.category(char) in ("Mn", "Me") or char in "\u200d\ufe0e\ufe0f"
+
+
+def atoms(line):
+    """Split a line into unbreakable pieces."""
+    pieces = []
+    for atom in ATOMS.findall(line):
+        if pieces and len(atom) == 1 and glue(atom):
+            pieces[-1] += atom
+        else:
+            pieces.append(atom)
+    return pieces
+
+
+def split_line(line, limit, encoding="utf-8"):
+    chunks = []
+    chunk, size = [], 0
+    lastspace = None  # Index in chunk right after the last space, our preferred place to break
+    for atom in atoms(line):
+        length = len(atom.encode(encoding))
+        while chunk and size + length > limit:
+            if lastspace:
+                chunks.append("".join(chunk[:lastspace]).rstrip(" "))
+                chunk = chunk[lastspace:]
+            else:
+                chunks.append("".join(chunk))
+                chunk = []
+            size = sum(len(a.encode(encoding)) for a in chunk)
+            lastspace = None
+        chunk.append(atom)
+        size += length
+        if atom == " ":
+            lastspace = len(chunk)
+    chunks.append("".join(chunk))
+    return chunks
+
+
+@functools.lru_cache(maxsize=512)
+def split(text, limit, encoding="utf-8"):
+    """
+    Split text into IRC lines of at most `limit` encoded bytes each. Newlines always start a new
+    line, everything else is broken at a space if possible. Results are cached, so the same
+    ASCII art or donger sent over and over again only gets measured once.
+    """
+    lines = []
+    for line in text.replace("\r", "").split("\n"):
+        # Some IRC servers respond with "412 Bot :No text to send" on empty messages.
+        lines.extend(chunk or " " for chunk in split_line(line, limit, encoding))
+    return tuple(lines)
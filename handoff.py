@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Hands the live IRC connection over to a freshly started copy of the bot (see extcmd/update.py).
+# The old process stops reading, then sends the socket itself (SCM_RIGHTS) and everything it knows
+# (channels, users, the fight going on) over a Unix socket. The new process picks up exactly where
+# the old one stopped reading, so nobody on IRC notices a thing.
+#
+# This only works for plaintext connections: a TLS session's state lives inside the old process'
+# OpenSSL and can't be moved, so update.py reconnects the old-fashioned way for those.
+import asyncio
+import logging
+import os
+import pickle
+import socket
+import struct
+import tempfile
+
+import pydle
+
+ENV = 'DONGERDONG_HANDOFF'  # Set (to the Unix socket's path) for a process that should adopt a connection
+HEADER = struct.Struct('!Q')  # Size of the pickled state that follows
+
+
+def snapshot(client, exclude=()):
+    """Every attribute of the client that can be pickled, except the ones in `exclude`."""
+    state = {}
+    for name, value in vars(client).items():
+        if name in exclude:
+            continue
+        try:
+            pickle.dumps(value)
+        except Exception:
+            logging.debug("Not handing over {0}: can't pickle it".format(name))
+            continue
+        state[name] = value
+    return state
+
+
+def restore(client, state):
+    for name, value in state.items():
+        setattr(client, name, value)
+
+
+def listen():
+    """Returns the listening socket and its path, see close()."""
+    # Whoever connects gets our IRC connection (and whoever we connect to gets unpickled), so the
+    # socket lives in a directory only we can get into from the moment it exists
+    path = os.path.join(tempfile.mkdtemp(prefix='dongerdong-'), 'handoff.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    listener.setblocking(False)
+    return listener, path
+
+
+def close(listener, path):
+    listener.close()
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+
+
+def busy(client):
+    """The messages pydle is still handling, other than the one we're running in."""
+    this = asyncio.current_task()
+    return [task for task in asyncio.all_tasks(client.eventloop)
+            if task is not this and task.get_coro().__name__ == 'on_raw']
+
+
+async def handover(client, conn, timeout=30, settle=15):
+    """
+    Give client's connection to whoever is on the other end of conn. Returns True once the new process
+    has taken over (the caller should get out of the way), or False if it didn't and we carry on.
+    """
+    loop = client.eventloop
+    connection = client.connection
+    # Commands that are halfway through (a !hit waiting on an account lookup, say) would be cut off
+    # and whatever they already changed would go over half done. Wait until nothing is running,
+    # still reading in the meantime since some of them are waiting on replies from the server.
+    started = loop.time()
+    while busy(client):
+        if loop.time() - started > settle:
+            logging.error("Still busy after {0}s, not handing over".format(settle))
+            conn.close()
+            return False
+        await asyncio.sleep(0.1)
+
+    # From here to the snapshot nothing is awaited, so nothing else gets to run in between
+    connection.writer.transport.pause_reading()
+    # Whatever the stream reader already got from the server but pydle didn't get to handle yet.
+    # Taking it out now means nothing can be handled twice.
+    leftover = client._receive_buffer + bytes(connection.reader._buffer)
+    connection.reader._buffer.clear()
+    client._receive_buffer = b''
+    state = client.handoffState()
+
+    await connection.writer.drain()
+    payload = pickle.dumps({'hostname': connection.hostname, 'port': connection.port, 'encoding': client.encoding,
+                            'leftover': leftover, 'state': state})
+    try:
+        socket.send_fds(conn, [HEADER.pack(len(payload))], [connection.writer.get_extra_info('socket').fileno()])
+        await loop.sock_sendall(conn, payload)
+        ack = await asyncio.wait_for(loop.sock_recv(conn, 1), timeout)
+    except (OSError, asyncio.TimeoutError):
+        ack = None
+    conn.close()
+
+    if ack:
+        logging.info("Handed the connection over, bye")
+        return True
+
+    logging.error("The new process didn't take the connection, carrying on")
+    connection.reader.feed_data(leftover)
+    connection.writer.transport.resume_reading()
+    client.cancelHandoff()
+    return False
+
+
+def recvall(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1048576))
+        if not chunk:
+            raise ConnectionError("Handoff socket closed early")
+        data += chunk
+    return bytes(data)
+
+
+async def adopt(client, path):
+    """Take over the connection and state offered on the Unix socket at path."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    header, fds, flags, address = socket.recv_fds(sock, HEADER.size, 1)
+    if not fds:
+        raise ConnectionError("No connection was handed over")
+    header += recvall(sock, HEADER.size - len(header))
+    handed = pickle.loads(recvall(sock, HEADER.unpack(header)[0]))
+
+    reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=fds[0]))
+    client.connection = pydle.connection.Connection(handed['hostname'], handed['port'], eventloop=client.eventloop)
+    client.connection.reader, client.connection.writer = reader, writer
+    client.encoding = handed['encoding']
+    client.restoreState(handed['state'])
+    sock.sendall(b'!')
+    sock.close()
+
+    # Whatever the old process had read but not handled goes first
+    client._receive_buffer = handed['leftover']
+    await client.on_data(b'')
+    client.eventloop.create_task(client.handle_forever())
+    logging.info("Took over the connection to {0}".format(handed['hostname']))
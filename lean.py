@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Lean membership tracking for the channels where the bot only answers commands (the auxchans).
+# pydle keeps a record for everybody in every channel it's in and WHOXes the whole channel when it
+# joins, which in a channel with thousands of people costs a lot of memory and a flood of WHO
+# replies on every connect, all for nothing: only the fight channel needs to know who's there and
+# who they're identified as. In a lean channel nobody is put on the user list, people only get a
+# user record once they use a command (and lose it when they leave), and their accounts are looked
+# up when a command needs them.
+#
+#   python3 lean.py [users]    # How much that saves on a made up channel (default 20000 users)
+import pydle
+
+
+class LeanChannels:
+    """Mixin for the pydle client, goes before it. Needs self.channel (the fight channel)."""
+    lean = True  # False tracks every channel in full, like pydle does
+
+    def leanChannel(self, channel):
+        return self.lean and self.is_channel(channel) and not self.is_same_channel(channel, self.channel)
+
+    async def on_raw_join(self, message):
+        nick, metadata = self._parse_user(message.source)
+        channels = message.params[0].split(',')
+        if not all(self.leanChannel(channel) for channel in channels):
+            return await super().on_raw_join(message)
+
+        if self.is_same_nick(self.nickname, nick):
+            # Set the channel up like pydle does, minus the WHOX for everybody in it (and the
+            # extended-join bits, it only looks at the channel list)
+            await pydle.features.RFC1459Support.on_raw_join(self, message)
+        else:
+            for channel in channels:
+                await self.on_join(channel, nick)
+
+    async def on_raw_353(self, message):
+        # NAMES is the whole channel, we only want it where we track people
+        if not self.leanChannel(message.params[2]):
+            await super().on_raw_353(message)
+
+    async def on_raw_privmsg(self, message):
+        nick, metadata = self._parse_user(message.source)
+        target, text = message.params
+        if nick in self.users or not self.leanChannel(target) or text.startswith("!"):
+            return await super().on_raw_privmsg(message)
+        # Chatter from somebody we don't know, it goes through without making a user record
+        await self.on_message(target, nick, text)
+        await self.on_channel_message(target, nick, text)
+
+    # Leaving or changing nicks, for somebody we never knew about. Skipping pydle here saves it
+    # from creating a record just to throw it away again (and a WHOIS on servers without WHOX)
+
+    async def on_raw_part(self, message):
+        nick, metadata = self._parse_user(message.source)
+        if nick in self.users or self.is_same_nick(self.nickname, nick):
+            return await super().on_raw_part(message)
+        reason = message.params[1] if len(message.params) > 1 else None
+        for channel in message.params[0].split(','):
+            await self.on_part(channel, nick, reason)
+
+    async def on_raw_quit(self, message):
+        nick, metadata = self._parse_user(message.source)
+        if nick in self.users or self.is_same_nick(self.nickname, nick):
+            return await super().on_raw_quit(message)
+        await self.on_quit(nick, message.params[0] if message.params else None)
+
+    async def on_raw_nick(self, message):
+        nick, metadata = self._parse_user(message.source)
+        if nick in self.users or self.is_same_nick(self.nickname, nick):
+            return await super().on_raw_nick(message)
+        await self.on_nick_change(nick, message.params[0])
+
+    # Ops kicking people and setting modes get a record from pydle like anybody else
+
+    async def on_raw_kick(self, message):
+        nick, metadata = self._parse_user(message.source)
+        known = nick in self.users
+        await super().on_raw_kick(message)
+        if not known:
+            self.forget(nick)
+
+    async def on_raw_mode(self, message):
+        nick, metadata = self._parse_user(message.source)
+        known = nick in self.users
+        await super().on_raw_mode(message)
+        if not known:
+            self.forget(nick)
+
+    def forget(self, nick):
+        """Drop nick's record if it isn't on any of the user lists we keep."""
+        if nick in self.users and not self.is_same_nick(self.nickname, nick) and \
+                not any(nick in channel['users'] for channel in self.channels.values()):
+            del self.users[nick]
+
+    def _destroy_user(self, nickname, channel=None):
+        # Kicks and kills can still be about people that were never on any of our lists
+        if nickname not in self.users:
+            return
+        super()._destroy_user(nickname, channel)
+        # pydle 0.9 stops at the mode lists and never takes anybody off the user lists (or out of
+        # self.users), so the fight channel kept everybody who ever left it
+        for ch in ([self.channels[channel]] if channel else self.channels.values()):
+            ch['users'].discard(nickname)
+        self.forget(nickname)
+
+if __name__ == "__main__":
+    import asyncio
+    import logging
+    import sys
+    import time
+    import tracemalloc
+
+    from pydle.features.rfc1459.parsing import RFC1459Message
+
+    USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    NAMES = 40  # Nicks per RPL_NAMREPLY, about what fits in 512 bytes
+
+    class Bench(LeanChannels, pydle.featurize(pydle.features.RFC1459Support, pydle.features.WHOXSupport,
+                                              pydle.features.AccountSupport, pydle.features.IRCv3_1Support)):
+        channel = "#fight"
+
+        async def _send(self, line):
+            self.sent.append(line)
+
+    def lines(client):
+        # What the server sends when we join #lobby, plus the WHOX replies if we asked for them
+        nicks = ["{0}user{1}".format("@" if i % 50 == 0 else "", i) for i in range(USERS)]
+        yield ":bench!bench@bench.host JOIN #lobby"
+        for i in range(0, USERS, NAMES):
+            yield ":irc.example 353 bench = #lobby :" + " ".join(nicks[i:i + NAMES])
+        yield ":irc.example 366 bench #lobby :End of /NAMES list."
+        if any(line.startswith("WHO ") for line in client.sent):
+            for i in range(USERS):
+                yield ":irc.example 354 bench 542 ~user{0} host{0}.example user{0} {1} :Real Name".format(i, "acct{0}".format(i) if i % 3 else "0")
+            yield ":irc.example 315 bench #lobby :End of /WHO list."
+
+    async def join(lean, trace):
+        client = Bench("bench")
+        client.lean = lean
+        client.nickname = "bench"
+        client.registered = True
+        client._isupport['WHOX'] = True
+        client.sent = []
+
+        if trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        received = 0
+        for line in lines(client):
+            received += len(line) + 2
+            await client.on_raw(RFC1459Message.parse(line.encode()))
+        elapsed = time.perf_counter() - started
+        if not trace:
+            return elapsed
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return memory, received, len(client.users)
+
+    logging.disable(logging.CRITICAL)
+    print("Joining a channel with {0} users:".format(USERS))
+    for lean in (False, True):
+        elapsed = min(asyncio.run(join(lean, False)) for _ in range(3))  # (tracemalloc slows everything down)
+        memory, received, users = asyncio.run(join(lean, True))
+        print("  {0:5} {1:7.0f}ms {2:8.1f}KiB kept {3:8.1f}KiB received {4:6} user records".format(
+            "lean" if lean else "full", elapsed * 1000, memory / 1024, received / 1024, users))
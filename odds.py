@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Exact odds for 1v1 fights, for !odds and the turn announcements.
+#
+# A 1v1 fight is fully described by (my hp, my heals, their hp, their heals) with me to move:
+# the gdr damage reduction never kicks in, because it's reset at the start of your turn and
+# you only get hit once before your next one. Both players are assumed to pick whatever gives
+# them the best chance (hit or heal) and !praise is left out. Since healing can undo hits the
+# game graph has cycles, so instead of a plain recursion this is value iteration, with prefix
+# sums so a whole damage or healing roll costs O(1). Solving takes a while in pure Python, so the
+# tables are saved and only built again if they're missing.
+#
+#   python3 odds.py    # Build the tables ahead of time
+import array
+import os
+import sys
+
+HP = 100
+HEALS = 5
+DAMAGE = (18, 35)  # random.randint(18, 35), doubled on a critical
+CRIT = 1 / 12
+INSTAKILL = 1 / 75  # Only when it's not a duel or deathmatch
+STATES = (HP + 1) * (HEALS + 1) * (HP + 1) * (HEALS + 1)
+
+
+def healmax(heals):
+    return 44 - (HEALS - heals) * 4
+
+
+def index(hp, heals, opphp, oppheals):
+    return ((hp * (HEALS + 1) + heals) * (HP + 1) + opphp) * (HEALS + 1) + oppheals
+
+
+def sweep(table, instakill):
+    """One round of value iteration. Returns the new table and the biggest change."""
+    low, high = DAMAGE
+    rolls = high - low + 1
+    ik = INSTAKILL if instakill else 0
+    offset = 2 * high + 2  # g[] below starts a bit under -2 * high, where the biggest crit leaves you
+    new = array.array('d', bytes(8 * STATES))
+
+    # Hitting: my chance is 1 minus theirs once it's their turn (with my heals back to 5), or 1 if they drop.
+    hitting = {}
+    for oppheals in range(HEALS + 1):
+        for hp in range(1, HP + 1):
+            g = [1.0] * (offset + 1) + [1 - table[index(opphp, oppheals, hp, HEALS)] for opphp in range(1, HP + 1)]
+            prefix = [0.0]  # prefix[i] = sum(g[:i])
+            for value in g:
+                prefix.append(prefix[-1] + value)
+            stride = g[:2] + [0.0] * (len(g) - 2)  # stride[i] = g[i] + g[i - 2] + ...
+            for i in range(2, len(g)):
+                stride[i] = g[i] + stride[i - 2]
+            row = [0.0] * (HP + 1)
+            for opphp in range(1, HP + 1):
+                at = opphp + offset
+                normal = (prefix[at - low + 1] - prefix[at - high]) / rolls
+                crit = (stride[at - 2 * low] - stride[at - 2 * high - 2]) / rolls
+                row[opphp] = ik + (1 - ik) * ((1 - CRIT) * normal + CRIT * crit)
+            hitting[hp, oppheals] = row
+
+    delta = 0.0
+    for opphp in range(1, HP + 1):
+        for oppheals in range(HEALS + 1):
+            # Healing: my chance is 1 minus theirs with me at the new hp and one heal less
+            healing = {}
+            for heals in range(1, HEALS + 1):
+                h = [0.0] + [1 - table[index(opphp, oppheals, hp, heals - 1)] for hp in range(1, HP + 1)]
+                prefix = [0.0]
+                for value in h:
+                    prefix.append(prefix[-1] + value)
+                healing[heals] = (h, prefix)
+
+            for hp in range(1, HP + 1):
+                hit = hitting[hp, oppheals][opphp]
+                for heals in range(HEALS + 1):
+                    best = hit
+                    if heals:
+                        h, prefix = healing[heals]
+                        lo, hi = hp + 22, hp + healmax(heals)
+                        if lo > HP:
+                            heal = h[HP]
+                        elif hi > HP:
+                            heal = (prefix[HP + 1] - prefix[lo] + (hi - HP) * h[HP]) / (hi - lo + 1)
+                        else:
+                            heal = (prefix[hi + 1] - prefix[lo]) / (hi - lo + 1)
+                        if heal > best:
+                            best = heal
+                    i = index(hp, heals, opphp, oppheals)
+                    change = abs(best - table[i])
+                    if change > delta:
+                        delta = change
+                    new[i] = best
+    return new, delta
+
+
+def solve(instakill=False, tolerance=1e-6, progress=None):
+    table = array.array('d', [0.5]) * STATES
+    delta = 1
+    sweeps = 0
+    while delta > tolerance:
+        table, delta = sweep(table, instakill)
+        sweeps += 1
+        if progress:
+            progress(sweeps, delta)
+    return table
+
+
+class Odds:
+    """The solved tables for both rulesets, read from (or written to) `directory`."""
+    def __init__(self, directory="."):
+        self.directory = directory
+        self.tables = {}  # instakill -> table
+
+    def path(self, instakill):
+        return os.path.join(self.directory, "odds-{0}.bin".format("fight" if instakill else "duel"))
+
+    def load(self):
+        """Load the saved tables, True if both were there."""
+        for instakill in (False, True):
+            table = array.array('d')
+            try:
+                with open(self.path(instakill), "rb") as f:
+                    table.fromfile(f, STATES)
+            except (OSError, EOFError):
+                return False
+            self.tables[instakill] = table
+        return True
+
+    def build(self, progress=None):
+        for instakill in (False, True):
+            if instakill in self.tables:
+                continue
+            table = solve(instakill, progress=progress)
+            with open(self.path(instakill), "wb") as f:
+                table.tofile(f)
+            self.tables[instakill] = table
+
+    @property
+    def ready(self):
+        return len(self.tables) == 2
+
+    def chance(self, hp, heals, opphp, oppheals, instakill=False):
+        """Chance that the player about to move wins. hp above 100 counts as 100."""
+        return self.tables[instakill][index(max(min(hp, HP), 1), heals, max(min(opphp, HP), 1), oppheals)]
+
+
+if __name__ == "__main__":
+    odds = Odds(sys.argv[1] if len(sys.argv) > 1 else ".")
+    odds.build(lambda sweeps, delta: print("sweep {0}: {1:.2e}".format(sweeps, delta)))
+    print("Full health, my turn: {0:.2%} (duel), {1:.2%} (fight)".format(odds.chance(100, 5, 100, 5),
+                                                                        odds.chance(100, 5, 100, 5, True)))
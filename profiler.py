@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# On-demand profiling for the live bot (see the !profile and !memprofile admin commands).
+# Everything ends up in a report file, and the top few hotspots get sent back over IRC.
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def where(filename, lineno, name):
+    return "{0} ({1}:{2})".format(name, os.path.basename(filename), lineno)
+
+
+class Sampler(threading.Thread):
+    """Sampling profiler: looks at one thread's stack every `interval` seconds and counts what it sees."""
+    def __init__(self, thread_id, interval=0.005):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.own = {}  # Frame that was actually running -> times seen
+        self.total = {}  # Frame anywhere on the stack -> times seen
+        self.running = True
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples += 1
+                leaf = True
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, frame.f_lineno if leaf else code.co_firstlineno, code.co_name)
+                    if leaf:
+                        self.own[key] = self.own.get(key, 0) + 1
+                        key = (code.co_filename, code.co_firstlineno, code.co_name)
+                        leaf = False
+                    if key not in seen:  # Recursion shouldn't count twice
+                        self.total[key] = self.total.get(key, 0) + 1
+                        seen.add(key)
+                    frame = frame.f_back
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+class Profiler:
+    def __init__(self, directory="profiles"):
+        self.directory = directory
+        self.kind = None  # 'cprofile' or 'sample' while a capture is running
+        self.started = 0
+        self.profile = None
+        self.sampler = None
+        self.memwatch = False  # True while !memprofile is waiting for its second snapshot
+
+    def reportpath(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, "{0}-{1}.txt".format(name, time.strftime("%Y%m%d-%H%M%S")))
+
+    def start(self, kind="cprofile", interval=0.005):
+        """Start a capture on the calling thread (that is, the event loop)."""
+        if kind == "sample":
+            self.sampler = Sampler(threading.get_ident(), interval)
+            self.sampler.start()
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.kind = kind
+        self.started = time.time()
+
+    def stop(self, top=10):
+        """Stop the capture, write the report and return (report path, top hotspot lines)."""
+        duration = time.time() - self.started
+        if self.kind == "sample":
+            path, lines = self.samplereport(duration, top)
+        else:
+            path, lines = self.cprofilereport(duration, top)
+        self.kind = None
+        self.profile = None
+        self.sampler = None
+        return path, lines
+
+    def cprofilereport(self, duration, top):
+        self.profile.disable()
+        path = self.reportpath("cprofile")
+        self.profile.dump_stats(path[:-4] + ".prof")  # For snakeviz and friends
+
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        out.write("cProfile capture, {0:.1f} seconds\n\n".format(duration))
+        stats.sort_stats("tottime").print_stats(50)
+        stats.sort_stats("cumulative").print_stats(50)
+        with open(path, "w") as f:
+            f.write(out.getvalue())
+
+        hottest = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+        lines = ["{0:.3f}s own, {1:.3f}s total, {2} calls: {3}".format(tt, ct, nc, where(*func))
+                 for func, (cc, nc, tt, ct, callers) in hottest]
+        return path, lines
+
+    def samplereport(self, duration, top):
+        self.sampler.stop()
+        samples = self.sampler.samples or 1
+        own = sorted(self.sampler.own.items(), key=lambda item: item[1], reverse=True)
+        total = sorted(self.sampler.total.items(), key=lambda item: item[1], reverse=True)
+
+        path = self.reportpath("sample")
+        with open(path, "w") as f:
+            f.write("Sampling capture, {0:.1f} seconds, {1} samples\n\n".format(duration, self.sampler.samples))
+            f.write("Running (self):\n")
+            for key, count in own[:50]:
+                f.write("  {0:6.2%}  {1}\n".format(count / samples, where(*key)))
+            f.write("\nOn the stack (inclusive):\n")
+            for key, count in total[:50]:
+                f.write("  {0:6.2%}  {1}\n".format(count / samples, where(*key)))
+
+        lines = ["{0:.1%} of samples: {1}".format(count / samples, where(*key)) for key, count in own[:top]]
+        return path, lines
+
+
+async def memdiff(seconds, top=10, directory="profiles"):
+    """Compare two tracemalloc snapshots `seconds` apart. Returns (report path, top growth lines)."""
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(10)
+    noise = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+
+    before = tracemalloc.take_snapshot().filter_traces(noise)
+    await asyncio.sleep(seconds)
+    after = tracemalloc.take_snapshot().filter_traces(noise)
+    if started:
+        tracemalloc.stop()
+
+    diff = after.compare_to(before, "lineno")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "memory-{0}.txt".format(time.strftime("%Y%m%d-%H%M%S")))
+    with open(path, "w") as f:
+        f.write("tracemalloc diff over {0} seconds\n\n".format(seconds))
+        for stat in diff[:100]:
+            f.write("{0}\n".format(stat))
+        f.write("\nTracebacks for the biggest growth:\n")
+        for stat in after.compare_to(before, "traceback")[:10]:
+            f.write("\n{0:+.1f} KiB in {1:+d} blocks\n".format(stat.size_diff / 1024, stat.count_diff))
+            f.write("\n".join(stat.traceback.format()) + "\n")
+
+    lines = ["{0:+.1f} KiB ({1:+d} blocks): {2}:{3}".format(stat.size_diff / 1024, stat.count_diff,
+                                                           os.path.basename(stat.traceback[0].filename), stat.traceback[0].lineno)
+             for stat in diff[:top]]
+    return path, lines
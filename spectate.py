@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Relays what happens in a fight to whoever is watching: aux channels, the stats API's /live
+# stream, anything else that subscribes. Every event is rendered once when it's published and then
+# dropped into each subscriber's own small queue, so publishing never waits. A subscriber that
+# can't keep up loses events instead of slowing the fight down:
+#
+#   'drop'      throws away the oldest queued events
+#   'condense'  throws away the queued hits and heals and puts a one-line scoreboard in their place
+#               (start, death and win events are kept), good for flood-limited IRC channels
+import asyncio
+import collections
+import re
+import time
+
+FORMATTING = re.compile(r"\x03(?:\d{1,2}(?:,\d{1,2})?)?|[\x02\x0f\x16\x1d\x1f]")
+MINOR = ('hit', 'heal', 'state')  # What 'condense' is allowed to fold away
+
+
+class Subscriber:
+    def __init__(self, name, maxsize=20, policy='drop'):
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = collections.deque()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def put(self, event):
+        if len(self.queue) >= self.maxsize:
+            if self.policy == 'condense':
+                kept = [e for e in self.queue if e['type'] not in MINOR]
+                self.dropped += len(self.queue) - len(kept)
+                self.queue = collections.deque(kept)
+                if event['type'] in MINOR and event.get('state'):
+                    text = scoreboard(event['state'])
+                    event = dict(event, type='state', text=text, plain=FORMATTING.sub("", text))
+            while len(self.queue) >= self.maxsize:
+                self.queue.popleft()
+                self.dropped += 1
+        self.queue.append(event)
+        self.ready.set()
+
+    async def get(self, timeout=None):
+        """Next event, or None if nothing happened for `timeout` seconds."""
+        while not self.queue:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.queue.popleft()
+
+
+def scoreboard(state):
+    return "Still standing: " + ", ".join("\002{0}\002 ({1}HP)".format(p['nick'], p['hp']) for p in state)
+
+
+class Relay:
+    def __init__(self):
+        self.subscribers = []
+        self.published = asyncio.Event()  # For readers that watch several subscribers at once
+
+    def subscribe(self, name, maxsize=20, policy='drop'):
+        subscriber = Subscriber(name, maxsize, policy)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.remove(subscriber)
+
+    def publish(self, kind, text, state=None):
+        """
+        Send an event to everybody. text is IRC formatted (plain text goes along as 'plain'), state
+        is the list of players still alive ({'nick': ..., 'hp': ...}), used for condensing.
+        """
+        if not self.subscribers:
+            return
+        event = {'type': kind, 'time': time.time(), 'text': text, 'plain': FORMATTING.sub("", text), 'state': state}
+        for subscriber in self.subscribers:
+            subscriber.put(event)
+        self.published.set()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Tiny HTTP server for the stats page, running on the bot's own event loop. It serves JSON
+# straight from memory (and the bot's response cache), with ETags so polling clients mostly
+# get a 304 back instead of the whole thing again.
+import asyncio
+import hashlib
+import json
+import logging
+import urllib.parse
+
+STATUS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class NotFound(Exception):
+    pass
+
+
+# Query parameter parsers for route(). They get the raw value (None if it's missing) and always
+# return something usable, so every way of asking for the same thing shares one cache entry.
+
+def number(default, low, high):
+    """An int clamped to low..high, default if it isn't one."""
+    def parse(value):
+        try:
+            return min(max(int(value), low), high)
+        except (TypeError, ValueError):
+            return default
+    return parse
+
+
+def oneof(*options):
+    """One of options, the first one if it's anything else."""
+    return lambda value: value if value in options else options[0]
+
+
+class StatsAPI:
+    def __init__(self, cache=None):
+        self.cache = cache  # cache.ResponseCache shared with the bot, so it can drop our entries when stats change
+        self.routes = {}  # '/leaderboard': (handler, prefix, cacheable, params)
+        self.streams = {}  # Same, for endpoints that keep the connection open (server-sent events)
+        self.server = None
+
+    def route(self, path, handler, prefix=False, cacheable=True, params=None):
+        """
+        Serve handler(rest, query) as JSON on path. rest is whatever follows path for prefix routes
+        ('/player/' + name) and query has the parameters in params ({'limit': number(10, 1, 100)}),
+        parsed. Anything else in the query string is ignored. Raise NotFound for a 404.
+        """
+        self.routes[path] = (handler, prefix, cacheable, params or {})
+
+    def stream(self, path, handler):
+        """Serve an endless text/event-stream on path: handler(query) is an async generator of events (None for a keepalive)."""
+        self.streams[path] = handler
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logging.info("Stats API listening on {0}:{1}".format(host, port))
+
+    def find(self, routes, path):
+        if path in routes:
+            return routes[path], ""
+        for route, entry in routes.items():
+            if entry[1] and path.startswith(route):
+                return entry, urllib.parse.unquote(path[len(route):])
+        return None, None
+
+    def render(self, path, rest, query, handler, cacheable, params):
+        """Returns (etag, body), from the cache when possible."""
+        # Only what the handler reads goes in (and in the cache key), so made up parameters can't
+        # fill the cache with copies of the same response
+        query = {name: parse(query.get(name, [None])[0]) for name, parse in params.items()}
+
+        def build():
+            body = json.dumps(handler(rest, query), default=str).encode("utf-8")
+            return '"{0}"'.format(hashlib.sha1(body).hexdigest()[:20]), body
+
+        if cacheable and self.cache is not None:
+            return self.cache.get(('api', path, tuple(sorted(query.items()))), build)
+        return build()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:  # Keep-alive
+                try:
+                    requestline = await asyncio.wait_for(reader.readline(), 30)
+                    if not requestline:
+                        break
+
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        if len(headers) > 50:
+                            return await self.respond(writer, 400, {'error': 'too many headers'}, close=True)
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                except asyncio.TimeoutError:
+                    break
+                except (ValueError, asyncio.LimitOverrunError):  # A line longer than the reader's limit (64KiB)
+                    return await self.respond(writer, 400, {'error': 'line too long'}, close=True)
+
+                try:
+                    method, target, version = requestline.decode("latin-1").split()
+                except ValueError:
+                    return await self.respond(writer, 400, {'error': 'bad request'}, close=True)
+                close = version != "HTTP/1.1" or headers.get("connection", "").lower() == "close"
+
+                if method not in ("GET", "HEAD"):
+                    await self.respond(writer, 405, {'error': 'GET only'}, close=close)
+                else:
+                    url = urllib.parse.urlsplit(target)
+                    query = urllib.parse.parse_qs(url.query)
+                    if url.path in self.streams:
+                        return await self.eventstream(writer, self.streams[url.path](query))
+                    await self.serve(writer, method, url.path, query, headers, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, writer, method, path, query, headers, close):
+        route, rest = self.find(self.routes, path)
+        if not route:
+            return await self.respond(writer, 404, {'error': 'not found'}, close=close)
+
+        handler, prefix, cacheable, params = route
+        try:
+            etag, body = self.render(path, rest, query, handler, cacheable, params)
+        except NotFound:
+            return await self.respond(writer, 404, {'error': 'not found'}, close=close)
+        except Exception:
+            logging.exception("Stats API handler for {0} failed".format(path))
+            return await self.respond(writer, 500, {'error': 'oops'}, close=close)
+
+        if etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+            return await self.send(writer, 304, b"", etag, close, head=True)
+        await self.send(writer, 200, body, etag, close, head=(method == "HEAD"))
+
+    async def respond(self, writer, status, data, close=False):
+        await self.send(writer, status, json.dumps(data).encode("utf-8"), None, close)
+
+    async def send(self, writer, status, body, etag, close, head=False):
+        lines = ["HTTP/1.1 {0} {1}".format(status, STATUS[status]),
+                 "Content-Type: application/json; charset=utf-8",
+                 "Content-Length: {0}".format(len(body)),
+                 "Cache-Control: no-cache",  # Always ask, we'll just say 304 if nothing changed
+                 "Access-Control-Allow-Origin: *"]
+        if etag:
+            lines.append("ETag: {0}".format(etag))
+        if close:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (b"" if head else body))
+        await writer.drain()
+
+    async def eventstream(self, writer, events):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        try:
+            async for event in events:
+                if event is None:  # Nothing happened for a while, make sure they're still there
+                    writer.write(b": keepalive\n\n")
+                else:
+                    writer.write("data: {0}\n\n".format(json.dumps(event, default=str)).encode("utf-8"))
+                await writer.drain()
+        finally:
+            await events.aclose()
@@ -0,0 +1,45 @@
+import datetime
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import daily
+
+
+def game(time, player1, player2, turns, winner):
+    # A GameStats row, as far as daily.rows() cares
+    fields = {'time': time, 'player1': player1, 'player2': player2, 'turns': turns, 'winner': winner}
+    for n in (1, 2):
+        fields.update({'player{0}_{1}'.format(n, stat): n for stat in ('hits', 'heals', 'praise', 'totdmg', 'totheal', 'crits')})
+    return types.SimpleNamespace(**fields)
+
+
+class BackfillTest(unittest.TestCase):
+    def test_turns_once_per_game(self):
+        day = datetime.datetime(2020, 5, 17, 12)
+        games = [game(day, "Polsaker", "ravioli", 7, 1), game(day, "ravioli", "Polsaker", 12, 1)]
+        days, players = daily.rows(games)
+
+        self.assertEqual(len(days), 1)
+        self.assertEqual(days[0]['games'], 2)
+        self.assertEqual(days[0]['turns'], sum(g.turns for g in games))
+        self.assertEqual(days[0]['matches'], 4)
+        # Everybody played every turn of their own games
+        self.assertEqual({p['name'].lower(): p['turns'] for p in players}, {'polsaker': 19, 'ravioli': 19})
+        self.assertEqual({p['name'].lower(): p['wins'] for p in players}, {'polsaker': 1, 'ravioli': 1})
+
+    def test_crits_and_unfinished_games(self):
+        day = datetime.datetime(2020, 5, 17, 12)
+        games = [game(day, "Polsaker", "ravioli", 7, 2), game(day, "Polsaker", "ravioli", 30, 0)]
+        days, players = daily.rows(games)
+
+        self.assertEqual(days[0]['games'], 1)
+        self.assertEqual(days[0]['turns'], 7)
+        self.assertEqual(days[0]['crits'], 3)
+        self.assertEqual({p['name'].lower(): p['crits'] for p in players}, {'polsaker': 1, 'ravioli': 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Notices when something blocks the event loop. A heartbeat task on the loop keeps checking in,
+# and a thread watches it: if the heartbeat is late by more than the threshold, the thread grabs
+# the loop's stack (and whatever command it was handling) and writes it to the stall report.
+# The heartbeat's lateness is also kept for !lag.
+import asyncio
+import collections
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+import traceback
+
+
+class Watchdog(threading.Thread):
+    def __init__(self, loop, threshold=0.5, report="stalls.log", interval=0.1):
+        super().__init__(name="loop-watchdog", daemon=True)
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.loopthread = None  # Set by the heartbeat, it's whatever thread runs the loop
+        self.lastbeat = time.monotonic()
+        self.lags = collections.deque(maxlen=6000)  # How late every heartbeat was, in seconds (the last ten minutes or so)
+        self.stalls = 0
+        self.laststall = None  # (time.time(), seconds, what was running)
+
+        # The report gets its own logger so it doesn't go through (or wait for) the main log
+        self.report = logging.getLogger("stalls")
+        self.report.propagate = False
+        if report:
+            handler = logging.handlers.RotatingFileHandler(report, maxBytes=1048576, backupCount=3, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.report.addHandler(handler)
+        self.report.setLevel(logging.INFO)
+
+    async def heartbeat(self):
+        self.loopthread = threading.get_ident()
+        while True:
+            self.lastbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(time.monotonic() - self.lastbeat - self.interval, 0))
+
+    def running(self):
+        """Name of the task the loop is running, which on_message names after the command."""
+        task = asyncio.current_task(self.loop)
+        if task is None:
+            return "(no task, a callback)"
+        return "{0} ({1})".format(task.get_name(), task.get_coro().__qualname__)
+
+    def run(self):
+        stalled = None  # lastbeat of the heartbeat we're stuck on
+        while True:
+            time.sleep(self.interval / 2)
+            beat = self.lastbeat
+            late = time.monotonic() - beat - self.interval
+            if late <= self.threshold:
+                if stalled is not None:
+                    total = time.monotonic() - stalled - self.interval
+                    self.laststall = self.laststall[:1] + (total,) + self.laststall[2:]
+                    self.report.info("Stall over after {0:.2f}s".format(total))
+                    stalled = None
+                continue
+            if stalled == beat or self.loopthread is None:
+                continue
+
+            # Still stuck, take a look at what it's doing
+            stalled = beat
+            frame = sys._current_frames().get(self.loopthread)
+            what = self.running()
+            self.stalls += 1
+            self.laststall = (time.time(), late, what)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no stack)\n"
+            self.report.info("Event loop stalled for {0:.2f}s so far, running {1}:\n{2}".format(late, what, stack))
+            logging.warning("Event loop stalled for {0:.2f}s, running {1}, see the stall report".format(late, what))
+
+    def summary(self):
+        if not self.lags:
+            return "No heartbeats yet."
+        lags = sorted(self.lags)
+        line = "Loop lag over the last {0} heartbeats: p50 {1:.1f}ms, p95 {2:.1f}ms, p99 {3:.1f}ms, max {4:.0f}ms. {5} stalls over {6}s.".format(
+            len(lags), lags[len(lags) // 2] * 1000, lags[int(len(lags) * 0.95)] * 1000, lags[int(len(lags) * 0.99)] * 1000,
+            lags[-1] * 1000, self.stalls, self.threshold)
+        if self.laststall:
+            line += " Last one {0:.0f} minutes ago, {1:.1f}s in {2}.".format((time.time() - self.laststall[0]) / 60, self.laststall[1], self.laststall[2])
+        return line
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8
+# Shared access to the wisdom/*.json corpora for the extended commands. Every corpus is loaded
+# once and gets an inverted index (token -> entries) so !jaden <word> and friends don't have to
+# scan every single entry. The index is saved next to the corpus and reused until the corpus changes.
+import bisect
+import json
+import os
+import random
+import re
+
+TOKEN = re.compile(r"\w+")
+
+stores = {}  # Loaded corpora, by path
+
+
+def tokenize(text):
+    return set(TOKEN.findall(text.lower()))
+
+
+class WisdomStore:
+    def __init__(self, path):
+        self.path = path
+        self.entries = json.load(open(path, 'r', encoding='utf-8'))
+        self.index = self.load_index()
+        if self.index is None:
+            self.index = self.build_index()
+            self.save_index()
+        self.tokens = sorted(self.index)  # For prefix lookups
+
+    def signature(self):
+        st = os.stat(self.path)
+        return [st.st_mtime_ns, st.st_size]
+
+    def index_path(self):
+        directory, name = os.path.split(self.path)
+        return os.path.join(directory, ".{0}.idx".format(name))
+
+    def load_index(self):
+        try:
+            saved = json.load(open(self.index_path(), 'r', encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+        if saved.get('source') != self.signature():  # Somebody added more wisdom
+            return None
+        return saved['index']
+
+    def build_index(self):
+        index = {}
+        for i, entry in enumerate(self.entries):
+            for token in tokenize(entry):
+                index.setdefault(token, []).append(i)
+        return index
+
+    def save_index(self):
+        try:
+            with open(self.index_path(), 'w', encoding='utf-8') as f:
+                json.dump({'source': self.signature(), 'index': self.index}, f)
+        except OSError:
+            pass  # Read-only checkout or whatever, we'll just build it again next time
+
+    def lookup(self, word):
+        """Entries matching a single word. 'word*' matches by prefix, and so does a plain word with no exact hits."""
+        word = word.lower()
+        if not word.endswith("*") and word in self.index:
+            return set(self.index[word])
+
+        prefix = word.rstrip("*")
+        if not prefix:
+            return set(range(len(self.entries)))
+        matches = set()
+        for i in range(bisect.bisect_left(self.tokens, prefix), len(self.tokens)):
+            if not self.tokens[i].startswith(prefix):
+                break
+            matches.update(self.index[self.tokens[i]])
+        return matches
+
+    def search(self, words):
+        """Indexes of the entries matching all the given words (rarest first, so the intersection shrinks fast)."""
+        terms = []
+        for word in words:
+            tokens = TOKEN.findall(word.lower())
+            if tokens and word.endswith("*"):
+                tokens[-1] += "*"
+            terms.extend(tokens)
+        if not terms:  # Nothing we can search for ("!jaden ???"), which isn't the same as asking for anything
+            return []
+        results = sorted((self.lookup(t) for t in terms), key=len)
+        matches = results[0]
+        for result in results[1:]:
+            matches &= result
+            if not matches:
+                break
+        return sorted(matches)
+
+    def random(self, words=None):
+        """A random entry matching the words (or any entry at all), None if nothing matches."""
+        if not words:
+            return random.choice(self.entries)
+        matches = self.search(words)
+        return self.entries[random.choice(matches)] if matches else None
+
+
+def load(path):
+    """Get the store for a corpus, loading it the first time somebody asks."""
+    if path not in stores:
+        stores[path] = WisdomStore(path)
+    return stores[path]